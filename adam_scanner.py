@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Discovery of ADAM modules and other Modbus/TCP devices on a subnet
+Usage: python adam_scanner.py [subnet] [port] [concurrency]
+Example: python adam_scanner.py 10.72.3 502 64
+"""
+
+import asyncio
+import logging
+import sys
+import time
+
+from advantech_adam import AdamDevice
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SUBNET = "10.0.0"
+MODBUS_PORT = 502
+SCAN_CONCURRENCY = 64
+CONNECT_TIMEOUT_SEC = 1.0
+MODBUS_TIMEOUT_SEC = 1.0
+
+
+class ScanResult:
+    def __init__(self, ip: str, port: int):
+        self.ip = ip
+        self.port = port
+        self.modbus = False
+        self.module_info = None
+        self.digital_inputs = None
+        self.connect_time = None
+
+    def __str__(self):
+        if not self.modbus:
+            return f"{self.ip}:{self.port} port open, no Modbus response"
+        return f"{self.ip}:{self.port} connect {self.connect_time * 1000:.0f} ms, module {self.module_info}, DI {self.digital_inputs}"
+
+
+class AdamScanner:
+    def __init__(self, port: int = MODBUS_PORT, concurrency: int = SCAN_CONCURRENCY):
+        self.port = port
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def port_open(self, ip: str) -> bool:
+        # Plain TCP connect first, cheap for the hosts which do not listen at all
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, self.port), CONNECT_TIMEOUT_SEC)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+    async def probe(self, ip: str) -> ScanResult:
+        async with self.semaphore:
+            started = time.monotonic()
+            if not await self.port_open(ip):
+                return None
+            result = ScanResult(ip, self.port)
+            result.connect_time = time.monotonic() - started
+            adam = AdamDevice(ip, port=self.port, timeout=MODBUS_TIMEOUT_SEC, retries=0)
+            try:
+                if await adam.connect():
+                    result.module_info = await adam.read_module_info()
+                    result.digital_inputs = await adam.read_digital_inputs(count=8)
+                    result.modbus = result.module_info is not None or result.digital_inputs is not None
+            except Exception as e:
+                log.debug(f"Modbus probe of {ip} failed: {e}")
+            finally:
+                await adam.disconnect()
+            return result
+
+    async def scan(self, subnet: str) -> list[ScanResult]:
+        ips = [f"{subnet}.{i}" for i in range(1, 255)]
+        results = await asyncio.gather(*(self.probe(ip) for ip in ips))
+        return [result for result in results if result]
+
+
+async def main():
+    subnet = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SUBNET
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else MODBUS_PORT
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else SCAN_CONCURRENCY
+
+    print(f"Scanning subnet: {subnet}.1-254 port {port}, {concurrency} parallel probes")
+    started = time.monotonic()
+    results = await AdamScanner(port, concurrency).scan(subnet)
+    print("==========================")
+    for result in results:
+        print(result)
+    print("==========================")
+    print(f"Scan complete in {time.monotonic() - started:.1f} sec, {len(results)} hosts with open port {port}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main())
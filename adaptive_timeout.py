@@ -0,0 +1,86 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+INITIAL_RTO_SEC = 1.0
+MIN_RTO_SEC = 0.1
+MAX_RTO_SEC = 3.0
+CLOCK_GRANULARITY_SEC = 0.01
+
+
+def frame_time(baudrate: int, chars: int) -> float:
+    """Time to transfer chars on RTU line, 11 bits per character (start, 8 data, parity or 2nd stop, stop)"""
+    return chars * 11 / baudrate
+
+
+def read_frame_chars(count: int) -> int:
+    # Read holding registers request 8 chars, response 5 chars + 2 per register
+    return 13 + 2 * count
+
+
+def write_frame_chars(count: int) -> int:
+    # Write multiple registers request 9 chars + 2 per register, response 8 chars
+    return 17 + 2 * count
+
+
+class RttEstimator:
+    """Slave response time estimator with retransmission timeout as in TCP (RFC 6298)
+
+    Samples are slave turnaround times, the wire time of the frames is added to the
+    timeout per transaction so one estimator serves blocks of any size.
+    """
+    def __init__(self, initial_rto: float = INITIAL_RTO_SEC, min_rto: float = MIN_RTO_SEC, max_rto: float = MAX_RTO_SEC):
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+        self.failures = 0 # consecutive timeouts
+        self.samples = 0
+        self.timeouts = 0
+
+    @property
+    def base_rto(self) -> float:
+        if self.srtt is None:
+            return self.initial_rto
+        return min(self.max_rto, max(self.min_rto, self.srtt + max(CLOCK_GRANULARITY_SEC, 4 * self.rttvar)))
+
+    @property
+    def rto(self) -> float:
+        return min(self.max_rto, self.base_rto * self.backoff)
+
+    def observe(self, rtt: float):
+        rtt = max(0.0, rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples += 1
+        self.answered()
+
+    def answered(self):
+        """Slave answered, answers to retried requests are not sampled (Karn's algorithm)"""
+        self.backoff = 1
+        self.failures = 0
+
+    def on_timeout(self):
+        # Back off as in Karn's algorithm, slow but alive slave gets more time on the retry
+        self.failures += 1
+        self.timeouts += 1
+        self.backoff *= 2
+
+    def end_block(self):
+        """Block failed completely, the slave is probably missing, next probe uses base timeout"""
+        self.backoff = 1
+
+    @property
+    def missing(self) -> bool:
+        return self.failures > 0
+
+    def __str__(self):
+        if self.srtt is None:
+            return f"rto {self.rto * 1000:.0f} ms, no samples, timeouts {self.timeouts}"
+        return f"srtt {self.srtt * 1000:.0f} ms, rttvar {self.rttvar * 1000:.0f} ms, rto {self.rto * 1000:.0f} ms, timeouts {self.timeouts}"
@@ -8,33 +8,59 @@ from pymodbus.client import AsyncModbusTcpClient
 from pymodbus.exceptions import ModbusException
 import asyncio
 import logging
+import socket
 
 log = logging.getLogger(__name__)
 
+# TCP keepalive detects half-open connection without waiting for a read timeout
+KEEPALIVE_IDLE_SEC = 10
+KEEPALIVE_INTERVAL_SEC = 5
+KEEPALIVE_COUNT = 3
+
 class AdamDevice:
-    def __init__(self, ip, port=502, slave_id=1, timeout=3):
+    def __init__(self, ip, port=502, slave_id=1, timeout=3, retries=3):
         self.ip = ip
         self.port = port
         self.slave_id = slave_id
         self.timeout = timeout
+        self.retries = retries
         self.client = None
 
     async def connect(self):
-        """Connect to the ADAM module"""
-        self.client = AsyncModbusTcpClient(host=self.ip, port=self.port, timeout=self.timeout)
+        """Connect to the ADAM module, previous connection is closed"""
+        await self.disconnect()
+        # Reconnects are left to the caller, pymodbus would otherwise reconnect in background
+        self.client = AsyncModbusTcpClient(host=self.ip, port=self.port, timeout=self.timeout, retries=self.retries, reconnect_delay=0)
         connection = await self.client.connect()
         
         if not connection:
             log.error(f"ADAM Failed to connect {self.ip}:{self.port}")
             return False
-        
+
+        self.enable_keepalive()
         log.info(f"ADAM Connected successfully {self.ip}:{self.port}")
         return True
 
+    def enable_keepalive(self):
+        sock = self.client.transport.get_extra_info("socket") if self.client.transport else None
+        if sock is None:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Fine tuning is Linux only
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE_SEC)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL_SEC)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+
+    @property
+    def connected(self) -> bool:
+        return bool(self.client and self.client.connected)
+
     async def disconnect(self):
         """Disconnect from the ADAM module"""
         if self.client:
-            await self.client.close()
+            self.client.close()
+            self.client = None
             log.info("Connection closed")
 
     async def read_digital_inputs(self, start_address=0, count=8):
@@ -127,22 +153,26 @@ class AdamDevice:
 
     async def read_module_info(self):
         """
-        Read module identification information
+        Read module identification information, returns dict with raw registers or None
         """
+        info = {}
         try:
             # Read module name (typically at holding register 0x0000)
             result = await self.client.read_holding_registers(0x0000, 4, slave=self.slave_id)
             if not result.isError():
                 log.info("Module Info:")
                 log.info(f"  Registers 0x0000-0x0003: {result.registers}")
+                info["module"] = result.registers
 
             # Read firmware version (location varies by model)
             result = await self.client.read_holding_registers(0x0004, 2, slave=self.slave_id)
             if not result.isError():
                 log.info(f"  Firmware info: {result.registers}")
+                info["firmware"] = result.registers
 
         except ModbusException as e:
             log.error(f"Error reading module info: {e}")
+        return info or None
 
     async def read_cycle(self, digital_count=8, holding_count=2):
         """
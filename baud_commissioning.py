@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Serial speed commissioning of the RS485 invertor bus
+Tries the line speeds from the fastest, keeps the fastest one where all configured
+slaves answer clean (CRC valid, complete) reads, and stores it per serial device.
+Usage: python baud_commissioning.py
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import time
+
+from pymodbus.client import AsyncModbusSerialClient
+
+from adaptive_timeout import frame_time, read_frame_chars
+
+log = logging.getLogger(__name__)
+
+BAUDRATES = [115200, 57600, 38400, 19200, 9600]
+STATE_FILE = "db/serial_baudrate.json"
+VERIFY_ROUNDS = 5
+VERIFY_ADDRESS = 32016 # PV1_U .. INTERNAL_TEMPERATURE, largest monitoring block
+VERIFY_COUNT = 72
+SLAVE_TURNAROUND_SEC = 0.5
+MAX_ERROR_RATE = 0.0
+
+
+def load_baudrate(device: str, state_file: str = STATE_FILE):
+    """Return baudrate stored for serial device or None"""
+    if not os.path.exists(state_file):
+        return None
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f).get(device)
+    except (json.JSONDecodeError, IOError) as e:
+        log.warning(f"Could not load serial speed from {state_file}: {e}")
+        return None
+
+
+def save_baudrate(device: str, baudrate: int, state_file: str = STATE_FILE):
+    state = {}
+    try:
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        log.warning(f"Could not load serial speed from {state_file}: {e}")
+    state[device] = baudrate
+    try:
+        os.makedirs(os.path.dirname(state_file), exist_ok=True)
+        with open(state_file, 'w') as f:
+            json.dump(state, f)
+        log.info(f"Stored serial speed {baudrate} for {device}")
+    except IOError as e:
+        log.error(f"Could not save serial speed to {state_file}: {e}")
+
+
+class BaudNegotiator:
+    def __init__(self, device: str, slaves: list[int], parity: str = "N", state_file: str = STATE_FILE):
+        self.device = device
+        self.slaves = slaves
+        self.parity = parity
+        self.state_file = state_file
+
+    async def verify(self, baudrate: int, rounds: int = VERIFY_ROUNDS) -> float:
+        """Read the verification block from every slave, returns error rate 0.0 - 1.0"""
+        client = AsyncModbusSerialClient(port=self.device, baudrate=baudrate, bytesize=8, parity=self.parity, stopbits=1,
+                                         timeout=10, retries=0, reconnect_delay=0)
+        if not await client.connect():
+            raise Exception(f"Cannot open {self.device}")
+        timeout = frame_time(baudrate, read_frame_chars(VERIFY_COUNT)) + SLAVE_TURNAROUND_SEC
+        requests = 0
+        errors = 0
+        try:
+            for _ in range(rounds):
+                for slave in self.slaves:
+                    requests += 1
+                    try:
+                        result = await asyncio.wait_for(client.read_holding_registers(VERIFY_ADDRESS, VERIFY_COUNT, slave=slave), timeout)
+                        # Frames with bad CRC are dropped by pymodbus and end as timeout
+                        if result.isError() or result.slave_id != slave or len(result.registers) != VERIFY_COUNT:
+                            errors += 1
+                    except Exception as e:
+                        log.debug(f"{self.device} {baudrate} slave {slave} read failed: {e}")
+                        errors += 1
+                    if errors and errors / (rounds * len(self.slaves)) > MAX_ERROR_RATE:
+                        # Rate is already rejected, do not waste bus time
+                        return errors / requests
+        finally:
+            client.close()
+        return errors / requests if requests else 1.0
+
+    async def negotiate(self, baudrates=BAUDRATES, persist: bool = True, slot=contextlib.nullcontext):
+        """Returns fastest clean baudrate and stores it, None when no speed works
+
+        slot() is an async context manager entered around every speed attempt, the
+        running monitor holds its bus in it and lets other transactions in between.
+        """
+        for baudrate in sorted(baudrates, reverse=True):
+            async with slot():
+                started = time.monotonic()
+                error_rate = await self.verify(baudrate)
+            log.info(f"{self.device} {baudrate} 8{self.parity}1 error rate {error_rate * 100:.0f}% ({time.monotonic() - started:.1f} sec)")
+            if error_rate <= MAX_ERROR_RATE:
+                if persist:
+                    save_baudrate(self.device, baudrate, self.state_file)
+                return baudrate
+        log.error(f"No serial speed works for all slaves {self.slaves} on {self.device}")
+        return None
+
+
+async def main():
+    from config import Config
+    config = Config()
+    baudrate = await BaudNegotiator(config.serial_device, config.modbus_slaves).negotiate()
+    print(f"Serial speed for {config.serial_device}: {baudrate}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+    asyncio.run(main())
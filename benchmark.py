@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the monitoring cycle against simulated invertors
+Runs goodwe_simulator.py and flask_server.py (cloud and Influx stand-in) as separate
+processes, so CPU time and peak RSS are those of the monitor alone. The outbox is a
+temporary messages.db.
+Usage: python benchmark.py [--invertors 4] [--cycles 5] [--backlog 500] [--latency 0.02]
+                           [--wire-format packed] [--compression gzip]
+                           [--output benchmarks] [--compare benchmarks/old.json]
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from cloud_sender import CloudSender, COMPRESSION_GZIP, COMPRESSION_ZSTD, WIRE_FORMAT_JSON, WIRE_FORMAT_PACKED
+from config import Config
+from event_sender import EventSender
+from influx import InfluxWriter
+from invertor_monitor_main import GoodweHTSet
+from msgdb import MsgDb
+from registers_goodwe_ht import GoodweHTRegs
+
+log = logging.getLogger(__name__)
+
+STARTUP_TIMEOUT_SEC = 10
+REGRESSION_THRESHOLD = 0.1
+# Result keys compared between runs, True when higher is better
+COMPARED_METRICS = {
+    "cycle.p50": False,
+    "cycle.p95": False,
+    "cpu_per_cycle.mean": False,
+    "backlog.messages_per_sec": True,
+    "peak_rss_kb": False,
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def distribution(values: list) -> dict:
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        "mean": statistics.fmean(values),
+        "p50": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+    }
+
+
+def version() -> str:
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.path.join(here, "IMAGE_VERSION")) as f:
+            image_version = f.read().strip()
+    except IOError:
+        image_version = "unknown"
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return f"{image_version} {commit}".strip()
+
+
+class Benchmark:
+    def __init__(self, args, temp_dir: str):
+        self.args = args
+        self.temp_dir = temp_dir
+        self.processes = []
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.serial_link = os.path.join(temp_dir, "ttySim")
+        self.monitor = None
+
+    async def start_stand_ins(self):
+        here = os.path.dirname(os.path.abspath(__file__))
+        self.processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(here, "flask_server.py"), "--port", str(self.port), "--quiet"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        simulator = [sys.executable, os.path.join(here, "goodwe_simulator.py"), "--slaves", str(self.args.invertors),
+                     "--link", self.serial_link, "--latency", str(self.args.latency), "--jitter", str(self.args.jitter),
+                     "--dropout", str(self.args.dropout)]
+        if self.args.baudrate:
+            simulator += ["--baudrate", str(self.args.baudrate)]
+        self.processes.append(subprocess.Popen(simulator, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+        deadline = time.monotonic() + STARTUP_TIMEOUT_SEC
+        while not os.path.exists(self.serial_link) or not await self.stand_in_ready():
+            if time.monotonic() > deadline:
+                raise Exception("Simulator or cloud stand-in did not start")
+            await asyncio.sleep(0.1)
+
+    async def stand_in_ready(self) -> bool:
+        try:
+            await self.stand_in_stats()
+            return True
+        except aiohttp.ClientError:
+            return False
+
+    async def stand_in_stats(self) -> dict:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{self.base_url}/stats") as res:
+                return await res.json()
+
+    def stop_stand_ins(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+    def create_monitor(self) -> GoodweHTSet:
+        config = Config()
+        config.plant = "benchmark"
+        config.serial_device = self.serial_link
+        config.modbus_slaves = list(range(1, self.args.invertors + 1))
+        config.cloud_svc_url = f"{self.base_url}/upload"
+        config.capture_file = None
+        config.serial_baudrate_auto = False
+        config.profile_log = os.path.join(self.temp_dir, "cycle_profile.jsonl")
+        if self.args.baudrate:
+            config.serial_baudrate = self.args.baudrate
+        influx_writer = InfluxWriter(url=self.base_url, token="benchmark", org="benchmark", bucket="benchmark")
+        event_sender = EventSender(None, None, os.path.join(self.temp_dir, "event_sender.state"))
+        monitor = GoodweHTSet(config, influx_writer, None, event_sender, CloudSender(config.cloud_svc_url, self.args.wire_format, self.args.compression))
+        monitor.db = MsgDb(os.path.join(self.temp_dir, "messages.db"))
+        monitor.capture = None
+        return monitor
+
+    async def run_cycles(self) -> dict:
+        monitor = self.monitor
+        # First cycle reads power adjust of every invertor and warms up the RTT estimates
+        await monitor.monitor_cycle()
+        totals = []
+        cpu = []
+        records = []
+        for _ in range(self.args.cycles):
+            started = time.perf_counter()
+            cpu_started = time.process_time()
+            await monitor.monitor_cycle()
+            totals.append(time.perf_counter() - started)
+            cpu.append(time.process_time() - cpu_started)
+            # Stage totals come from the cycle profile of the monitor itself
+            records.append(monitor.profiler.last_record)
+        stages = {}
+        for name in sorted({name for record in records for name in record["stages"]}):
+            stages[name] = distribution([record["stages"].get(name, {}).get("total", 0.0) for record in records])
+        return {"cycle": distribution(totals), "cpu_per_cycle": distribution(cpu), "stages": stages}
+
+    async def run_backlog(self) -> dict:
+        """Outbox drain throughput with a backlog as after a connectivity outage"""
+        monitor = self.monitor
+        message = monitor.generate_invetor_regs_json(GoodweHTRegs(), monitor.invertors[0], monitor.config)
+        for _ in range(self.args.backlog):
+            await monitor.db.insert_message("data", message)
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        sent = await monitor.drain_outbox(self.args.backlog)
+        elapsed = time.perf_counter() - started
+        return {
+            "messages": sent,
+            "seconds": elapsed,
+            "messages_per_sec": sent / elapsed if elapsed else 0.0,
+            "cpu_per_message": (time.process_time() - cpu_started) / sent if sent else None,
+        }
+
+    async def run(self) -> dict:
+        await self.start_stand_ins()
+        try:
+            self.monitor = self.create_monitor()
+            self.monitor.client = self.monitor.create_client()
+            await self.monitor.client.connect()
+            await self.monitor.db.connect()
+            try:
+                cycles = await self.run_cycles()
+                backlog = await self.run_backlog() if self.args.backlog else None
+            finally:
+                self.monitor.client.close()
+                await self.monitor.db.close()
+                self.monitor.influx_writer.close()
+            stand_in = await self.stand_in_stats()
+        finally:
+            self.stop_stand_ins()
+
+        return {
+            "version": version(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "params": {
+                "invertors": self.args.invertors, "cycles": self.args.cycles, "backlog": self.args.backlog,
+                "latency": self.args.latency, "jitter": self.args.jitter, "dropout": self.args.dropout,
+                "baudrate": self.args.baudrate, "wire_format": self.args.wire_format,
+                "compression": self.args.compression,
+            },
+            **cycles,
+            "backlog": backlog,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "stand_in": stand_in,
+        }
+
+
+def metric(results: dict, key: str):
+    value = results
+    for part in key.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def compare(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD, metrics: dict = COMPARED_METRICS) -> list:
+    """Lines describing metrics worse than baseline by more than threshold"""
+    regressions = []
+    for key, higher_is_better in metrics.items():
+        value, base = metric(results, key), metric(baseline, key)
+        if value is None or not base:
+            continue
+        change = (value - base) / base
+        worse = -change if higher_is_better else change
+        line = f"{key}: {base:.6g} -> {value:.6g} ({change * 100:+.1f} %)"
+        print(("REGRESSION " if worse > threshold else "           ") + line)
+        if worse > threshold:
+            regressions.append(line)
+    return regressions
+
+
+def print_results(results: dict):
+    print(f"Version {results['version']}, {results['params']['invertors']} invertors, {results['params']['cycles']} cycles")
+    cycle = results["cycle"]
+    print(f"Cycle: mean {cycle['mean'] * 1000:.1f} ms, p50 {cycle['p50'] * 1000:.1f} ms, p95 {cycle['p95'] * 1000:.1f} ms")
+    print(f"CPU per cycle: {results['cpu_per_cycle']['mean'] * 1000:.1f} ms")
+    for name, stage in results["stages"].items():
+        print(f"  {name:40} mean {stage['mean'] * 1000:8.2f} ms  p95 {stage['p95'] * 1000:8.2f} ms")
+    if results["backlog"]:
+        backlog = results["backlog"]
+        print(f"Backlog: {backlog['messages']} messages in {backlog['seconds']:.2f} sec, {backlog['messages_per_sec']:.1f} messages/sec")
+    print(f"Peak RSS: {results['peak_rss_kb'] / 1024:.1f} MB")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="End-to-end monitoring cycle benchmark")
+    parser.add_argument("--invertors", type=int, default=4)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--backlog", type=int, default=500, help="pending messages for the drain test, 0 skips it")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated slave turnaround in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--dropout", type=float, default=0.0)
+    parser.add_argument("--baudrate", type=int, help="simulate wire time of this line speed")
+    parser.add_argument("--wire-format", choices=[WIRE_FORMAT_JSON, WIRE_FORMAT_PACKED], default=WIRE_FORMAT_JSON, help="cloud upload format")
+    parser.add_argument("--compression", choices=[COMPRESSION_GZIP, COMPRESSION_ZSTD], help="Content-Encoding of cloud uploads")
+    parser.add_argument("--output", default="benchmarks", help="directory for the result JSON")
+    parser.add_argument("--compare", help="result JSON of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="allowed relative regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="benchmark_") as temp_dir:
+        results = await Benchmark(args, temp_dir).run()
+    print_results(results)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"benchmark_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results stored to {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare} ({baseline.get('version')})")
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+    asyncio.run(main())
@@ -0,0 +1,118 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import time
+from enum import IntEnum
+
+from metrics import Counter, Histogram
+
+log = logging.getLogger(__name__)
+
+
+class BusPriority(IntEnum):
+    CONTROL = 0
+    REGULATION = 1
+    MONITORING = 2
+    DIAGNOSTICS = 3
+
+
+# Max seconds a transaction may wait for the bus before it is dropped, None waits forever
+DEFAULT_DEADLINES = {
+    BusPriority.CONTROL: None,
+    BusPriority.REGULATION: None,
+    BusPriority.MONITORING: 60.0,
+    BusPriority.DIAGNOSTICS: 10.0,
+}
+
+
+# Seconds of waiting that promote a transaction by one class, up to REGULATION; control is never overtaken
+AGING_SEC = 2.0
+
+
+class BusDeadlineExceeded(Exception):
+    pass
+
+
+class BusArbiter:
+    """Grants exclusive access to a shared Modbus client by priority class
+
+    Higher classes go first, transactions of the same class are served in arrival
+    order. A waiting transaction is promoted one class per AGING_SEC, at most to
+    REGULATION, so a steady stream of regulation reads does not starve monitoring
+    and diagnostics, while CONTROL always goes first. A transaction in flight is
+    never preempted.
+    """
+    def __init__(self, name: str = "bus"):
+        self.name = name
+        self.busy = False
+        self.waiters = []  # (priority, seq, enqueued at, future), a handful at most
+        self.seq = itertools.count()
+        self.wait_time = {
+            priority: Histogram(f"{name}_wait_seconds_{priority.name.lower()}", f"Time waiting for the {name} in class {priority.name}")
+            for priority in BusPriority
+        }
+        self.deadline_misses = Counter(f"{name}_deadline_misses_total", f"Transactions dropped waiting for the {name}", ("priority",))
+
+    async def acquire(self, priority: BusPriority, deadline: float = None):
+        started = time.monotonic()
+        if deadline is None:
+            deadline = DEFAULT_DEADLINES[priority]
+        if not self.busy and not self.waiters:
+            self.busy = True
+            self.wait_time[priority].observe(0.0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((priority, next(self.seq), started, future))
+        try:
+            await asyncio.wait_for(future, deadline)
+        except asyncio.TimeoutError:
+            self.deadline_misses.labels(priority.name.lower()).inc()
+            raise BusDeadlineExceeded(f"{self.name} not granted to {priority.name} within {deadline} sec")
+        except asyncio.CancelledError:
+            # Granted in the same moment as cancelled, pass the bus on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        self.wait_time[priority].observe(time.monotonic() - started)
+
+    @staticmethod
+    def rank(priority: BusPriority, enqueued_at: float, now: float) -> int:
+        """Class a waiting transaction competes in after aging"""
+        if priority == BusPriority.CONTROL:
+            return priority
+        return max(BusPriority.REGULATION, priority - int((now - enqueued_at) / AGING_SEC))
+
+    def release(self):
+        now = time.monotonic()
+        while self.waiters:
+            waiter = min(self.waiters, key=lambda waiter: (self.rank(waiter[0], waiter[2], now), waiter[1]))
+            self.waiters.remove(waiter)
+            future = waiter[3]
+            if not future.done():
+                future.set_result(True)
+                return
+        self.busy = False
+
+    @contextlib.asynccontextmanager
+    async def hold(self, priority: BusPriority, deadline: float = None):
+        """Hold the bus for a sequence of transactions"""
+        await self.acquire(priority, deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def execute(self, priority: BusPriority, func, *args, deadline: float = None, **kwargs):
+        """Run one transaction coroutine func(*args, **kwargs) when the bus is granted"""
+        async with self.hold(priority, deadline):
+            return await func(*args, **kwargs)
+
+    def summary(self) -> str:
+        lines = []
+        for priority in BusPriority:
+            histogram = self.wait_time[priority]
+            if histogram.count:
+                lines.append(f"{histogram.summary()}, deadline misses {self.deadline_misses.labels(priority.name.lower()).value}")
+        return "; ".join(lines) if lines else f"{self.name}: no transactions"
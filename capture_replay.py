@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Replays register blocks captured by the monitor (config.capture_file) through decode,
+JSON, outbox and Influx, as fast as possible or in real time
+Usage: python capture_replay.py capture_file [--realtime] [--speed N] [--db path] [--influx]
+Without --db the outbox is a temporary messages.db, without --influx the Influx points
+are only built and serialized to line protocol.
+"""
+
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import tempfile
+import time
+from typing import Iterator, List
+
+from config import Config
+from event_sender import EventSender
+from frame_capture import CapturedBlock, read_capture
+from influx import InfluxWriter
+from invertor import Invertor
+from invertor_monitor_main import GoodweHTSet, READ_BLOCKS
+from msgdb import MsgDb
+from registers_goodwe_ht import GoodweHTRegs, RegName
+
+log = logging.getLogger(__name__)
+
+
+def group_readings(blocks: Iterator[CapturedBlock]) -> Iterator[List[CapturedBlock]]:
+    """Blocks of one invertor reading, a reading starts with the first block of READ_BLOCKS"""
+    first_address = GoodweHTRegs().get(READ_BLOCKS[0][0]).address
+    reading = []
+    for block in blocks:
+        if reading and (block.address == first_address or block.slave != reading[0].slave):
+            yield reading
+            reading = []
+        reading.append(block)
+    if reading:
+        yield reading
+
+
+class Replay:
+    def __init__(self, config: Config, db_path: str, influx_writer: InfluxWriter = None, state_dir: str = None):
+        # Replay must not touch the live event sender state nor capture its own input again
+        event_sender = EventSender(None, None, os.path.join(state_dir or os.path.dirname(db_path), "event_sender.state"))
+        self.monitor = GoodweHTSet(config, influx_writer, None, event_sender, None)
+        self.monitor.db = MsgDb(db_path)
+        self.monitor.capture = None
+        self.invertors = {invertor.slave_address: invertor for invertor in self.monitor.invertors}
+        self.readings = 0
+        self.blocks = 0
+        self.line_protocol_bytes = 0
+
+    def invertor(self, slave: int) -> Invertor:
+        if slave not in self.invertors:
+            invertor = Invertor(len(self.invertors) + 1, slave)
+            self.invertors[slave] = invertor
+            self.monitor.invertors.append(invertor)
+        return self.invertors[slave]
+
+    async def process(self, reading: List[CapturedBlock]):
+        invertor = self.invertor(reading[0].slave)
+        timestamp = datetime.datetime.fromtimestamp(reading[0].timestamp, datetime.timezone.utc)
+        regs = GoodweHTRegs()
+        power_adjust_address = regs.get(RegName.POWER_ADJUST).address
+        for block in reading:
+            regs.decode(block.registers, block.address, block.address + len(block.registers) - 1)
+            if block.address == power_adjust_address:
+                self.monitor.revalidate_power_adjust(invertor, regs)
+        self.blocks += len(reading)
+        await self.monitor.process_invertor_regs(invertor, regs, timestamp)
+        if not self.monitor.influx_writer:
+            points = InfluxWriter.build_points(regs, invertor, timestamp)
+            self.line_protocol_bytes += sum(len(point.to_line_protocol()) for point in points)
+        self.readings += 1
+
+    async def run(self, path: str, realtime: bool = False, speed: float = 1.0):
+        await self.monitor.db.connect()
+        started = time.monotonic()
+        first_timestamp = None
+        try:
+            for reading in group_readings(read_capture(path)):
+                if realtime:
+                    if first_timestamp is None:
+                        first_timestamp = reading[0].timestamp
+                    delay = (reading[0].timestamp - first_timestamp) / speed - (time.monotonic() - started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await self.process(reading)
+        finally:
+            await self.monitor.db.close()
+        elapsed = time.monotonic() - started
+        rate = self.readings / elapsed if elapsed else 0.0
+        log.info(f"Replayed {self.readings} readings ({self.blocks} blocks) in {elapsed:.3f} sec, {rate:.1f} readings/sec")
+        if self.line_protocol_bytes:
+            log.info(f"Influx line protocol {self.line_protocol_bytes} bytes, not written")
+        return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay captured invertor register blocks")
+    parser.add_argument("capture_file")
+    parser.add_argument("--realtime", action="store_true", help="keep the captured timing between readings")
+    parser.add_argument("--speed", type=float, default=1.0, help="real time speed-up factor")
+    parser.add_argument("--db", help="outbox database, temporary one when not set")
+    parser.add_argument("--influx", action="store_true", help="write to Influx configured in config.py")
+    parser.add_argument("--verbose", action="store_true", help="log every reading as the monitor does")
+    args = parser.parse_args()
+    if not args.verbose:
+        for name in ("invertor_monitor_main", "invertor_regs", "invertor_json", "msgdb", "influx"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    config = Config()
+    influx_writer = None
+    if args.influx:
+        influx_writer = InfluxWriter(url=config.influx_url, token=config.influx_token, org=config.influx_org, bucket=config.influx_bucket)
+
+    with tempfile.TemporaryDirectory(prefix="replay_") as temp_dir:
+        db_path = args.db or os.path.join(temp_dir, "messages.db")
+        try:
+            await Replay(config, db_path, influx_writer, temp_dir).run(args.capture_file, args.realtime, args.speed)
+        finally:
+            if influx_writer:
+                influx_writer.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
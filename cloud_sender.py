@@ -1,6 +1,8 @@
 import asyncio
+import gzip
 import json
 import logging
+import struct
 import threading
 import time
 
@@ -8,12 +10,55 @@ import aiohttp
 
 from config import Config
 import flask_server
+from message_encoder import KEYFRAME_REQUEST_HEADER
+from metrics import Counter, Histogram
+from registers_goodwe_ht import GoodweHTRegs
+from wire_format import JSON_CONTENT_TYPE, PackedRecordCodec, loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
+WIRE_FORMAT_JSON = "json"
+WIRE_FORMAT_PACKED = "packed"
+PACKED_RETRY_SEC = 3600 # after the receiver refused packed records JSON is sent, then packed is tried again
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_LEVELS = {COMPRESSION_GZIP: 6, COMPRESSION_ZSTD: 3}
+COMPRESSION_MIN_BYTES = 256 # smaller bodies are sent as they are, gzip header and trailer alone take 18 bytes
+COMPRESSION_THREAD_BYTES = 64 * 1024 # larger bodies are compressed in a worker thread, not blocking the event loop
+COMPRESSION_RETRY_SEC = 3600 # after the receiver refused a Content-Encoding bodies go uncompressed, then it is tried again
+COMPRESSION_RATIO_BUCKETS = (1, 1.5, 2, 3, 5, 7, 10, 15, 20, 30)
+
+
 class CloudSender:
-    def __init__(self, url: str):
+    def __init__(self, url: str, wire_format: str = WIRE_FORMAT_JSON, compression: str = None,
+                 compression_level: int = None, compression_min_bytes: int = COMPRESSION_MIN_BYTES):
         self.url = url
+        # Packed records are negotiated by Content-Type, 415 falls back to JSON
+        self.codec = PackedRecordCodec(GoodweHTRegs()) if wire_format == WIRE_FORMAT_PACKED else None
+        self.packed_refused_at = None
+        if compression == COMPRESSION_ZSTD and zstandard is None:
+            logger.warning("zstandard module not installed, compressing cloud uploads with gzip")
+            compression = COMPRESSION_GZIP
+        elif compression and compression not in COMPRESSION_LEVELS:
+            logger.warning(f"Unknown cloud compression {compression}, sending uncompressed")
+            compression = None
+        self.compression = compression
+        self.compression_level = compression_level if compression_level is not None else COMPRESSION_LEVELS.get(compression)
+        self.compression_min_bytes = compression_min_bytes
+        # Compressor objects are not thread safe, the one of the event loop thread is kept
+        self.zstd_compressor = zstandard.ZstdCompressor(level=self.compression_level) if compression == COMPRESSION_ZSTD else None
+        self.compression_refused_at = None
+        self.latency = Histogram("cloud_send_seconds", "Upload of one message to the cloud service")
+        self.failures = Counter("cloud_send_failures_total", "Uploads failed with error status or exception")
+        self.body_bytes = Counter("cloud_body_bytes_total", "Upload body bytes before and after compression", ("stage",))
+        self.compression_ratio = Histogram("cloud_compression_ratio", "Uncompressed to compressed size of an upload body",
+                                           buckets=COMPRESSION_RATIO_BUCKETS)
+        self.compression_cpu = Counter("cloud_compression_cpu_seconds_total", "CPU time spent compressing upload bodies")
 
     async def start_mock(self):
         def run_flask():
@@ -23,18 +68,92 @@ class CloudSender:
         thread.start()
         await asyncio.sleep(1)  # Give Flask time to start
 
+    def encode(self, json_str: str):
+        """Body and Content-Type of the message in the wire format the receiver takes"""
+        if self.codec and (self.packed_refused_at is None or time.monotonic() - self.packed_refused_at > PACKED_RETRY_SEC):
+            try:
+                return self.codec.pack(loads(json_str)), self.codec.content_type
+            except (KeyError, TypeError, ValueError, struct.error) as e:
+                logger.warning(f"Message can not be packed, sending JSON: {e}")
+        return json_str, JSON_CONTENT_TYPE
+
+    def compress(self, body: bytes, zstd_compressor=None) -> bytes:
+        """Body compressed with the configured Content-Encoding, CPU time of the calling thread is counted"""
+        started = time.thread_time()
+        if self.compression == COMPRESSION_ZSTD:
+            compressor = zstd_compressor or zstandard.ZstdCompressor(level=self.compression_level)
+            compressed = compressor.compress(body)
+        else:
+            compressed = gzip.compress(body, compresslevel=self.compression_level, mtime=0)
+        self.compression_cpu.inc(time.thread_time() - started)
+        return compressed
+
+    async def compress_body(self, body):
+        """Body and its Content-Encoding, None when sent as it is"""
+        if isinstance(body, str):
+            body = body.encode()
+        self.body_bytes.labels("raw").inc(len(body))
+        if (not self.compression or len(body) < self.compression_min_bytes
+                or (self.compression_refused_at is not None and time.monotonic() - self.compression_refused_at <= COMPRESSION_RETRY_SEC)):
+            self.body_bytes.labels("sent").inc(len(body))
+            return body, None
+        if len(body) >= COMPRESSION_THREAD_BYTES:
+            compressed = await asyncio.to_thread(self.compress, body)
+        else:
+            compressed = self.compress(body, self.zstd_compressor)
+        self.body_bytes.labels("sent").inc(len(compressed))
+        self.compression_ratio.observe(len(body) / len(compressed))
+        return compressed, self.compression
+
+    async def post(self, session: aiohttp.ClientSession, body, content_type: str, encoding: str = None):
+        headers = {'Content-Type': content_type}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        async with session.post(self.url, data=body, headers=headers) as res:
+            return res.status, res.headers.get(KEYFRAME_REQUEST_HEADER), res.headers.get("Accept-Encoding")
+
+    @staticmethod
+    def encoding_refused(encoding: str, content_type: str, accept_encoding: str) -> bool:
+        """Whether a 415 answer refused the Content-Encoding rather than the Content-Type
+
+        Accept-Encoding of the answer (RFC 7694) decides when present, otherwise the
+        Content-Type is blamed first while it is not JSON, the encoding after it.
+        """
+        if accept_encoding is not None:
+            accepted = {token.split(";")[0].strip().lower() for token in accept_encoding.split(",")}
+            return encoding not in accepted
+        return content_type == JSON_CONTENT_TYPE
+
     async def send(self, json_str: str):
+        """Upload one message, returns keyframe request of the receiver if any"""
         logger.info("Sending message to cloud service...")
-        start_time = time.time()
-        async with aiohttp.ClientSession() as session:
-            res: aiohttp.ClientResponse = await session.post(
-                self.url,
-                data=json_str,
-                headers={'Content-Type': 'application/json'}
-            )
-            if res.status != 200:
-                #logger.error(f"Failed to send message, status: {res.status}")
-                raise Exception(f"Failed to send message, status {res.status}")
-        end_time = time.time()
-        execution_time = end_time - start_time
+        start_time = time.monotonic()
+        try:
+            async with aiohttp.ClientSession() as session:
+                while True:
+                    body, content_type = self.encode(json_str)
+                    body, encoding = await self.compress_body(body)
+                    status, keyframe_request, accept_encoding = await self.post(session, body, content_type, encoding)
+                    if status != 415:
+                        break
+                    if encoding and self.encoding_refused(encoding, content_type, accept_encoding):
+                        # Receiver without request decompression
+                        logger.warning(f"Cloud service refused {encoding} encoding, sending uncompressed for {COMPRESSION_RETRY_SEC} sec")
+                        self.compression_refused_at = time.monotonic()
+                    elif content_type != JSON_CONTENT_TYPE:
+                        # Receiver without packed records or with another register layout, the encoding is kept
+                        logger.warning(f"Cloud service refused {content_type}, sending JSON for {PACKED_RETRY_SEC} sec")
+                        self.packed_refused_at = time.monotonic()
+                    else:
+                        break
+                if status != 200:
+                    #logger.error(f"Failed to send message, status: {status}")
+                    raise Exception(f"Failed to send message, status {status}")
+        except Exception:
+            self.failures.inc()
+            raise
+        finally:
+            self.latency.observe(time.monotonic() - start_time)
+        execution_time = time.monotonic() - start_time
         logger.info(f"Successfully sent message to cloud service {execution_time:.2f} sec")
+        return keyframe_request
@@ -1,11 +1,28 @@
 from datetime import datetime
-from pymodbus import pymodbus_apply_logging_config
+import atexit
+import copy
+import gzip
+import json
 import logging
-import sys, os
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
 
 
 USE_FILES = True
 USE_STDOUT = True
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5 # rotated files kept gzipped as goodwe_monitor.log.1.gz ...
+LOG_QUEUE_SIZE = 10000 # records waiting for the writer thread, more are dropped
+# (records, seconds) per logger, dumps of a cycle of up to 10 invertors pass once an hour
+LOG_RATE_LIMITS = {
+    "invertor_regs": (200, 3600),
+    "invertor_json": (20, 3600),
+}
 
 class RFC3339Formatter(logging.Formatter):
     def formatTime(self, record, datefmt=None):
@@ -13,7 +30,97 @@ class RFC3339Formatter(logging.Formatter):
         dt = datetime.fromtimestamp(record.created)
         return dt.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
 
-def setup_logging(log_level: int):
+
+class JsonFormatter(RFC3339Formatter):
+    """One compact JSON object per line"""
+    def format(self, record):
+        data = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+class RateLimitFilter(logging.Filter):
+    """At most count records of a logger (and its children) per window of seconds
+
+    Meant for the per cycle dumps, the first ones in each window pass complete.
+    Number of dropped records is appended to the first record of the next window.
+    """
+    def __init__(self, limits: dict):
+        super().__init__()
+        self.limits = limits # logger name -> (count, seconds)
+        self.windows = {} # logger name -> [window start, passed, suppressed]
+        self.lock = threading.Lock()
+
+    def limit_name(self, name: str):
+        while name:
+            if name in self.limits:
+                return name
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record):
+        name = self.limit_name(record.name)
+        if name is None:
+            return True
+        count, seconds = self.limits[name]
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(name)
+            if window is None or now - window[0] >= seconds:
+                suppressed = window[2] if window else 0
+                window = self.windows[name] = [now, 0, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} [{suppressed} records of {name} suppressed]"
+            if window[1] >= count:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller, records are dropped when the writer thread falls behind
+
+    Number of dropped records is appended to the next record queued.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0 # since the last record queued, emit runs under the handler lock
+
+    def prepare(self, record):
+        # Message merged with its args, traceback kept apart as text for the JSON formatter
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.dropped:
+            record.msg = f"{record.msg} [{self.dropped} records dropped, log writer behind]"
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+
+
+def gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_logging(log_level: int, json_format: bool = False, max_bytes: int = LOG_MAX_BYTES, backups: int = LOG_BACKUPS, rate_limits: dict = None):
+    """Root logger writes through a queue, files and stdout are written by a background thread
+
+    rate_limits None applies LOG_RATE_LIMITS, an empty dict turns the limits off.
+    """
     root_logger = logging.getLogger()
     if root_logger.hasHandlers():
         root_logger.setLevel(log_level)
@@ -22,9 +129,13 @@ def setup_logging(log_level: int):
 #            root_logger.removeHandler(handler)
 
     #formatter = logging.Formatter("%(asctime)s %(name)s %(levelname)s — %(message)s")
-    formatter = RFC3339Formatter('%(asctime)s %(name)s %(levelname)s - %(message)s')
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = RFC3339Formatter('%(asctime)s %(name)s %(levelname)s - %(message)s')
 
     root_logger.setLevel(log_level)
+    handlers = []
 
     if USE_FILES:
         log_path = "./logs"
@@ -32,9 +143,11 @@ def setup_logging(log_level: int):
             root_logger.error("No 'logs' directory exists")
             raise Exception("No 'logs' directory exists")
         filename = "goodwe_monitor.log"
-        file_handler = logging.FileHandler("{0}/{1}".format(log_path, filename))
+        file_handler = logging.handlers.RotatingFileHandler("{0}/{1}".format(log_path, filename), maxBytes=max_bytes, backupCount=backups)
+        file_handler.namer = lambda name: name + ".gz"
+        file_handler.rotator = gzip_rotator
         file_handler.setFormatter(formatter)
-        root_logger.addHandler(file_handler)
+        handlers.append(file_handler)
 
     # logging.getLogger('pymodbus.payload').setLevel(logging.DEBUG)
     # logging.getLogger('pymodbus.transaction').setLevel(logging.DEBUG)
@@ -47,9 +160,21 @@ def setup_logging(log_level: int):
     if USE_STDOUT:
         _console_handler = logging.StreamHandler(sys.stdout)
         _console_handler.setFormatter(formatter)
-        root_logger.addHandler(_console_handler)
+        handlers.append(_console_handler)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    if rate_limits is None:
+        rate_limits = LOG_RATE_LIMITS
+    if rate_limits:
+        # Before the queue, dropped records cost no formatting
+        queue_handler.addFilter(RateLimitFilter(rate_limits))
+    root_logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
 
-    pymodbus_apply_logging_config(log_level)
+    # pymodbus_apply_logging_config() would add its own blocking stderr handler
+    logging.getLogger("pymodbus").setLevel(log_level)
 
 def get_date_iso_str():
     return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
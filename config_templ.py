@@ -4,7 +4,50 @@ class Config:
         self.modbus_slaves = [1, 2, 3, 4]
         self.cloud_svc_url = "http://joycare.joyce.cz:58081/goodweht/saveinverterdata/v1.0"
         self.serial_device = "/dev/ttyAMA2"
+        self.serial_baudrate = 9600
+        # Renegotiate serial speed (see baud_commissioning.py) when bus errors rise
+        self.serial_baudrate_auto = False
         self.adam_ip = "192.168.0.116"
+        self.regulation_poll_sec = 0.5
+        # Send power adjust as one Modbus broadcast (slave 0), only when no other device on the bus has register 41480
+        self.power_adjust_broadcast = False
+        self.power_adjust_ttl_sec = 3600
+        # Nominal power in kW, one value for all invertors or dict by slave address
+        self.invertor_nominal_power = 110
+        # Distribute plant power cap by live invertor power instead of same power adjust everywhere
+        self.plant_controller_enable = False
+        self.plant_controller_deadband = 2
+        # Append raw register blocks to this file for replay with capture_replay.py, None disables
+        self.capture_file = None
+        # Per cycle stage timing records, one JSON line per cycle, None disables
+        self.profile_log = "logs/cycle_profile.jsonl"
+        # Encode cloud messages with orjson when installed, output parses the same as with the json module
+        self.json_fast_backend = True
+        # Full message (keyframe) once per cloud_keyframe_interval messages of an invertor, only changed fields between,
+        # the cloud service must rebuild the records (see flask_server.py)
+        self.cloud_delta_enable = False
+        self.cloud_keyframe_interval = 12
+        # "packed" sends fixed layout binary records (wire_format.py), JSON again when the cloud service answers 415
+        self.cloud_wire_format = "json"
+        # Content-Encoding of cloud upload bodies: None, "gzip" or "zstd" (needs the zstandard module, gzip without it);
+        # level None is the default of the compressor, smaller bodies than cloud_compression_min_bytes go uncompressed
+        self.cloud_compression = None
+        self.cloud_compression_level = None
+        self.cloud_compression_min_bytes = 256
+        # Prometheus metrics on http://<host>:<port>/metrics, None disables
+        self.metrics_host = "0.0.0.0"
+        self.metrics_port = 9120
+        # Event loop blocked longer is a stall, its stack goes to http://<host>:<port>/stalls and to the log on SIGUSR1
+        self.loop_stall_threshold_sec = 0.2
+        # asyncio debug mode reports slow callbacks too, slows the monitor down
+        self.loop_debug = False
+        # Log file rotated by size, old files gzipped; one JSON object per line instead of text
+        self.log_max_bytes = 10 * 1024 * 1024
+        self.log_backups = 5
+        self.log_json = False
+        # At most (records, seconds) per logger, register and JSON dumps of every cycle are the bulk of the log;
+        # None keeps LOG_RATE_LIMITS of common.py, {} turns the limits off
+        self.log_rate_limits = None
 
         self.mail_enable = False
         self.mail_smtp_server="your.server.com"
@@ -0,0 +1,121 @@
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+PROFILE_LOG = "logs/cycle_profile.jsonl"
+MAX_PROFILE_LOG_BYTES = 10 * 1024 * 1024
+ROLLING_WINDOW = 288 # samples per span name, a day of 5 minute cycles
+SLOWEST_SPANS = 10 # spans kept in a cycle record besides the per stage totals
+SLOW_CYCLE_SEC = 60
+
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration: float):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+
+class CycleProfiler:
+    """Named spans with monotonic timestamps, aggregated per monitoring cycle
+
+    Spans may come from any task, spans of the regulation loop running during a
+    cycle land in its record too. Each cycle record is appended as one JSON line.
+    """
+    def __init__(self, path: str = PROFILE_LOG, window: int = ROLLING_WINDOW, slow_cycle_sec: float = SLOW_CYCLE_SEC):
+        self.path = path
+        self.slow_cycle_sec = slow_cycle_sec
+        self.window = window
+        self.rolling = {}  # name -> deque of recent durations
+        self.cycle_started = None
+        self.cycle_started_at = None
+        self.stages = {}
+        self.spans = []  # (duration, name, start offset) of the current cycle
+        self.last_record = None
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.monotonic())
+
+    def add(self, name: str, started: float, ended: float):
+        duration = ended - started
+        samples = self.rolling.get(name)
+        if samples is None:
+            samples = self.rolling[name] = deque(maxlen=self.window)
+        samples.append(duration)
+        if self.cycle_started is None or started < self.cycle_started:
+            return
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        stats.add(duration)
+        self.spans.append((duration, name, started - self.cycle_started))
+
+    def start_cycle(self):
+        self.cycle_started = time.monotonic()
+        self.cycle_started_at = datetime.datetime.now()
+        self.stages = {}
+        self.spans = []
+
+    def end_cycle(self) -> dict:
+        duration = time.monotonic() - self.cycle_started
+        slowest = sorted(self.spans, reverse=True)[:SLOWEST_SPANS]
+        record = {
+            "started": self.cycle_started_at.isoformat(timespec="milliseconds"),
+            "duration": round(duration, 4),
+            "stages": {name: {"count": stats.count, "total": round(stats.total, 4), "max": round(stats.max, 4)}
+                       for name, stats in self.stages.items()},
+            "slowest": [{"name": name, "start": round(start, 4), "duration": round(span, 4)} for span, name, start in slowest],
+        }
+        self.cycle_started = None
+        self.add("cycle", time.monotonic() - duration, time.monotonic())
+        self.last_record = record
+        if duration > self.slow_cycle_sec:
+            log.warning(f"Slow cycle {duration:.1f} sec, slowest spans: "
+                        + ", ".join(f"{span['name']} {span['duration']:.3f} sec at {span['start']:.1f}" for span in record["slowest"][:3]))
+        return record
+
+    def percentiles(self, name: str):
+        """(p50, p95, max) of the recent durations of the span"""
+        samples = sorted(self.rolling.get(name, ()))
+        if not samples:
+            return None
+        return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.95))], samples[-1]
+
+    def summary(self, names=None) -> str:
+        parts = []
+        for name in names or sorted(self.rolling):
+            values = self.percentiles(name)
+            if values:
+                parts.append(f"{name} p50 {values[0] * 1000:.0f} p95 {values[1] * 1000:.0f} max {values[2] * 1000:.0f} ms")
+        return "; ".join(parts)
+
+    def _write(self, line: str):
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > MAX_PROFILE_LOG_BYTES:
+                os.replace(self.path, self.path + ".1")
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+        except IOError as e:
+            log.error(f"Could not write cycle profile to {self.path}: {e}")
+
+    async def store(self, record: dict):
+        if self.path:
+            await asyncio.to_thread(self._write, json.dumps(record, separators=(",", ":")))
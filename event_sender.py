@@ -1,29 +1,87 @@
+import asyncio
 import logging
 import json
 import os
+import re
+import time
+from collections import deque
 from datetime import datetime, timedelta
 
 from mailer import Mailer
+from metrics import Counter
 
 logger = logging.getLogger(__name__)
 
 MAX_EVENTS_PER_HOUR = 10
+RATE_WINDOW_SEC = 3600
+QUEUE_SIZE = 50
+MAIL_BATCH_SIZE = 10
+STATE_SAVE_INTERVAL_SEC = 60
+COALESCE_WINDOW_SEC = 1800
+DIGEST_INTERVAL_SEC = 3600
+DIGEST_MAX_GROUPS = 50
+
+
+class EventGroup:
+    """Occurrences of events sharing one fingerprint"""
+    def __init__(self, subject: str, body: str):
+        self.subject = subject
+        self.body = body
+        self.first_seen = datetime.now()
+        self.last_seen = self.first_seen
+        self.last_mailed = None
+        self.suppressed = 0
+        self.sources = set()
+
+    def add(self, subject: str, body: str, source: str = None):
+        self.subject = subject
+        self.body = body
+        self.last_seen = datetime.now()
+        if source:
+            self.sources.add(source)
+
+    def reset(self):
+        self.suppressed = 0
+        self.sources = set()
+        self.first_seen = self.last_seen
+
 
 class EventSender:
-    def __init__(self, mailer: Mailer, to_address: str):
+    def __init__(self, mailer: Mailer, to_address: str, state_file: str = "db/event_sender.state"):
         self.mailer = mailer
         self.to_address = to_address
-        self.state_file = "db/event_sender.state"
+        self.state_file = state_file
+        # Sliding window of wall clock send times (epoch sec), oldest first
+        self.sent_times = deque(self._load_state().get("sent_times", []))
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.dispatch_task = None
+        self.pending = 0
+        self.state_dirty = False
+        self.state_saved_at = 0.0
+        self.groups: dict[str, EventGroup] = {}
+        self.digest_sent_at = time.monotonic()
+        self.suppressed = Counter("event_sender_suppressed_total", "Events not mailed at once, by reason", ("reason",))
 
     def _load_state(self):
+        state = {"sent_times": []}
         if os.path.exists(self.state_file):
             try:
                 with open(self.state_file, 'r') as f:
-                    return json.load(f)
+                    state = json.load(f)
             except (json.JSONDecodeError, IOError):
                 logger.warning(f"Could not load state from {self.state_file}")
-        return {"sent_times": []}
-    
+        # Older state files keep ISO strings, convert them once on load
+        sent_times = []
+        for timestamp in state.get("sent_times", []):
+            try:
+                if isinstance(timestamp, str):
+                    timestamp = datetime.fromisoformat(timestamp).timestamp()
+                sent_times.append(float(timestamp))
+            except (TypeError, ValueError):
+                logger.warning(f"Skipping invalid sent time {timestamp} in {self.state_file}")
+        state["sent_times"] = sorted(sent_times)
+        return state
+
     def _save_state(self, state):
         try:
             os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
@@ -31,58 +89,200 @@ class EventSender:
                 json.dump(state, f)
         except IOError as e:
             logger.error(f"Could not save state to {self.state_file}: {e}")
-    
+
+    async def _persist_state(self, force: bool = False):
+        if not self.state_dirty:
+            return
+        if not force and time.monotonic() - self.state_saved_at < STATE_SAVE_INTERVAL_SEC:
+            return
+        self.state_dirty = False
+        self.state_saved_at = time.monotonic()
+        state = {"sent_times": list(self.sent_times)}
+        await asyncio.to_thread(self._save_state, state)
+
     def _is_quiet_hours(self):
         current_time = datetime.now()
         hour = current_time.hour
         return hour >= 20 or hour < 7
-    
+
+    def _expire_sent_times(self):
+        one_hour_ago = time.time() - RATE_WINDOW_SEC
+        while self.sent_times and self.sent_times[0] <= one_hour_ago:
+            self.sent_times.popleft()
+
     def _can_send_event(self):
         if self._is_quiet_hours():
             return False
-            
-        state = self._load_state()
-        current_time = datetime.now()
-        one_hour_ago = current_time - timedelta(hours=1)
-        
-        recent_sends = [
-            datetime.fromisoformat(timestamp) 
-            for timestamp in state.get("sent_times", [])
-            if datetime.fromisoformat(timestamp) > one_hour_ago
-        ]
-
-        return len(recent_sends) < MAX_EVENTS_PER_HOUR
-    
+
+        self._expire_sent_times()
+        # Events queued or being sent will consume the budget too
+        return len(self.sent_times) + self.pending < MAX_EVENTS_PER_HOUR
+
     def _record_send(self):
-        state = self._load_state()
-        current_time = datetime.now()
-        one_hour_ago = current_time - timedelta(hours=1)
-        
-        state["sent_times"] = [
-            timestamp for timestamp in state.get("sent_times", [])
-            if datetime.fromisoformat(timestamp) > one_hour_ago
-        ]
-        
-        state["sent_times"].append(current_time.isoformat())
-        self._save_state(state)
-
-    async def send_event(self, subject: str, body: str = None):
+        self._expire_sent_times()
+        self.sent_times.append(time.time())
+        self.state_dirty = True
+
+    def _ensure_dispatcher(self):
+        if self.dispatch_task is None or self.dispatch_task.done():
+            self.dispatch_task = asyncio.create_task(self._dispatch())
+
+    def _fingerprint(self, subject: str, source: str = None) -> str:
+        """Subject without the source, numbers are normalised in the error text after the first ': ' only"""
+        if source:
+            subject = subject.replace(source, "")
+        prefix, separator, detail = subject.partition(": ")
+        return prefix + separator + re.sub(r"\d+", "#", detail)
+
+    async def send_event(self, subject: str, body: str = None, source: str = None, coalesce: bool = True):
+        """Queue event for sending, never waits for the mail to be delivered
+
+        Repeated events with the same fingerprint within COALESCE_WINDOW_SEC, events
+        over the rate limit and events in quiet hours are collected into a digest.
+        State changes (coalesce False) are mailed every time within the rate limit.
+        """
         logger.info(f"Sending event to {self.to_address} {subject}")
+        if not body:
+            body = subject
+        key = self._fingerprint(subject, source)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = EventGroup(subject, body)
+        group.add(subject, body, source)
+        self._ensure_dispatcher()
+
         if self._is_quiet_hours():
-            logger.info("Event blocked during quiet hours (20:00-07:00)")
+            logger.info("Event postponed to digest during quiet hours (20:00-07:00)")
+            group.suppressed += 1
+            self.suppressed.labels("quiet_hours").inc()
+            return False
+
+        if coalesce and group.last_mailed is not None and time.monotonic() - group.last_mailed < COALESCE_WINDOW_SEC:
+            logger.info(f"Event coalesced into digest, already sent in last {COALESCE_WINDOW_SEC} sec")
+            group.suppressed += 1
+            self.suppressed.labels("coalesced").inc()
             return False
-            
+
         if not self._can_send_event():
-            logger.warning(f"Event rate limit exceeded. Maximum {MAX_EVENTS_PER_HOUR} events per hour allowed.")
+            logger.warning(f"Event rate limit exceeded. Maximum {MAX_EVENTS_PER_HOUR} events per hour allowed, event postponed to digest.")
+            group.suppressed += 1
+            self.suppressed.labels("rate_limit").inc()
+            return False
+
+        if not self._enqueue(subject, body):
+            group.suppressed += 1
+            self.suppressed.labels("queue_full").inc()
             return False
-        
+        group.last_mailed = time.monotonic()
+        return True
+
+    def _enqueue(self, subject: str, body: str) -> bool:
         try:
-            if not body:
-                body = subject
-            if self.mailer:
-                await self.mailer.send_mail(self.to_address, subject, body)
-            self._record_send()
-            return True
-        except Exception as e:
-            logger.error(f"Error sending event {body} {e}")
-            return False
\ No newline at end of file
+            self.queue.put_nowait((subject, body))
+        except asyncio.QueueFull:
+            logger.warning(f"Event queue full, dropping event {subject}")
+            return False
+        self.pending += 1
+        return True
+
+    def _build_digest(self):
+        groups = [group for group in self.groups.values() if group.suppressed]
+        if not groups:
+            return None
+        groups.sort(key=lambda group: group.suppressed, reverse=True)
+        total = sum(group.suppressed for group in groups)
+        subject = f"Event digest: {total} events in {len(groups)} groups"
+        lines = []
+        for group in groups[:DIGEST_MAX_GROUPS]:
+            lines.append(f"{group.suppressed}x {group.subject}")
+            lines.append(f"  First seen: {group.first_seen:%Y-%m-%d %H:%M:%S}, last seen: {group.last_seen:%Y-%m-%d %H:%M:%S}")
+            if group.sources:
+                lines.append(f"  Invertors: {', '.join(sorted(group.sources))}")
+            if group.body != group.subject:
+                lines.append(f"  Last detail: {group.body}")
+            lines.append("")
+        if len(groups) > DIGEST_MAX_GROUPS:
+            lines.append(f"... and {len(groups) - DIGEST_MAX_GROUPS} more groups")
+        return subject, "\n".join(lines)
+
+    def _check_digest(self):
+        if time.monotonic() - self.digest_sent_at < DIGEST_INTERVAL_SEC:
+            return
+        # Digest from quiet hours goes out as the first thing in the morning
+        if self._is_quiet_hours():
+            return
+        digest = self._build_digest()
+        self.digest_sent_at = time.monotonic()
+        if digest:
+            subject, body = digest
+            logger.info(f"Sending {subject}")
+            if not self._enqueue(subject, body):
+                return
+        expire_before = datetime.now() - timedelta(seconds=COALESCE_WINDOW_SEC)
+        for key, group in list(self.groups.items()):
+            group.reset()
+            if group.last_seen < expire_before:
+                del self.groups[key]
+
+    async def _dispatch(self):
+        while True:
+            try:
+                batch = [await asyncio.wait_for(self.queue.get(), STATE_SAVE_INTERVAL_SEC)]
+            except asyncio.TimeoutError:
+                batch = []
+            # Everything already queued goes out in one SMTP session
+            while batch and len(batch) < MAIL_BATCH_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if batch:
+                try:
+                    if self.mailer:
+                        sent = await self.mailer.send_mails([(self.to_address, subject, body) for subject, body in batch])
+                    else:
+                        sent = len(batch)
+                    for _ in range(sent):
+                        self._record_send()
+                    if sent < len(batch):
+                        logger.error(f"Error sending events, sent {sent} of {len(batch)}")
+                except Exception as e:
+                    logger.error(f"Error sending events {batch} {e}")
+                finally:
+                    for _ in batch:
+                        self.pending -= 1
+                        self.queue.task_done()
+            try:
+                self._check_digest()
+                await self._persist_state()
+            except Exception as e:
+                logger.error(f"Could not persist event sender state: {e}")
+
+    async def close(self):
+        """Wait for queued events and the pending digest to be sent and store the rate limiter state"""
+        digest = self._build_digest()
+        if digest and self._enqueue(*digest):
+            self._ensure_dispatcher()
+        if self.dispatch_task:
+            await self.queue.join()
+            self.dispatch_task.cancel()
+            self.dispatch_task = None
+        if self.mailer:
+            await self.mailer.close()
+        await self._persist_state(force=True)
+
+
+async def check():
+    """Changed setpoints are mailed each, repeated errors coalesced"""
+    import tempfile
+    with tempfile.TemporaryDirectory() as temp_dir:
+        sender = EventSender(None, None, os.path.join(temp_dir, "event_sender.state"))
+        sender._is_quiet_hours = lambda: False
+        assert await sender.send_event("Updated Power Adjust plant to 0", coalesce=False)
+        assert await sender.send_event("Updated Power Adjust plant to 100", coalesce=False)
+        assert await sender.send_event("Updated Power Adjust plant to 0", coalesce=False)
+        assert await sender.send_event("Failed to process invertor monitoring Slave: 1: timeout after 3 sec", source="Slave: 1")
+        assert not await sender.send_event("Failed to process invertor monitoring Slave: 2: timeout after 4 sec", source="Slave: 2")
+        await sender.close()
+        print(f"{len(sender.sent_times)} mailed, {sum(group.suppressed for group in sender.groups.values())} coalesced")
+
+
+if __name__ == '__main__':
+    asyncio.run(check())
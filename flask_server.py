@@ -1,12 +1,252 @@
-from flask import Flask, request
+#!/usr/bin/env python3
+"""
+Local stand-in for the cloud service and InfluxDB, used by the mock and benchmarks
+Usage: python flask_server.py [--port 5000] [--quiet] [--latency SEC] [--fail-rate P]
+Cloud data: POST /upload or /goodweht/saveinverterdata/v1.0 as in the production URL
+Influx: POST /api/v2/write, statistics: GET /stats, reset: DELETE /stats
+Delta encoded messages (cloud_delta_enable) are rebuilt to full records, newest
+record of every invertor: GET /records
+Packed binary records (cloud_wire_format = "packed") are decoded, --no-packed answers 415
+Compressed bodies (cloud_compression) are decompressed, --no-compression answers 415
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import random
+import struct
+import threading
+import time
+import zlib
+
+from flask import Flask, jsonify, request
+
+from message_encoder import FRAME_DELTA, FRAME_KEY, KEYFRAME_REQUEST_HEADER, rebuild
+from registers_goodwe_ht import GoodweHTRegs
+from wire_format import PACKED_CONTENT_TYPE, PackedRecordCodec
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DECOMPRESS_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
 
 app = Flask(__name__)
 
+settings = {
+    "quiet": False,
+    "latency": 0.0, # seconds before each cloud response
+    "fail_rate": 0.0, # part of cloud uploads answered with 500
+    "packed": True, # accept packed binary records
+    "compression": True, # accept gzip and zstd request bodies
+}
+codec = PackedRecordCodec(GoodweHTRegs())
+KEPT_KEYFRAMES = 48 # per invertor, deltas of older keyframes can not be rebuilt
+MAX_PARKED = 1000 # deltas per invertor waiting for their keyframe
+SEQ_WINDOW = 1000 # newest sequence numbers per invertor checked for gaps
+stats_lock = threading.Lock()
+stats = {}
+streams = {} # (plant, slave address) -> Stream, guarded by stats_lock
+
+
+class Stream:
+    """Delta encoded messages of one invertor, they may come in any order"""
+    def __init__(self):
+        self.keyframes = {} # seq -> keyframe message
+        self.parked = {} # key seq -> deltas waiting for the keyframe
+        self.parked_count = 0
+        self.min_seq = None
+        self.max_seq = None
+        self.seen = set() # sequence numbers within SEQ_WINDOW of max_seq
+        self.latest_seq = None
+        self.latest = None
+
+    def track(self, seq: int) -> bool:
+        """Record sequence number, True when it is the newest one so far"""
+        newest = self.max_seq is None or seq > self.max_seq
+        if newest:
+            self.max_seq = seq
+            self.seen = {seen for seen in self.seen if seen > seq - SEQ_WINDOW}
+        if self.min_seq is None or seq < self.min_seq:
+            self.min_seq = seq
+        if seq > self.max_seq - SEQ_WINDOW:
+            self.seen.add(seq)
+        return newest
+
+    def missing(self) -> int:
+        """Gaps between the oldest and newest message within the window"""
+        if self.max_seq is None:
+            return 0
+        return self.max_seq - max(self.min_seq, self.max_seq - SEQ_WINDOW + 1) + 1 - len(self.seen)
+
+    def add_record(self, seq: int, record: dict):
+        if self.latest_seq is None or seq >= self.latest_seq:
+            self.latest_seq = seq
+            self.latest = record
+
+    def receive(self, message: dict):
+        """Full records rebuilt thanks to the message and whether a keyframe is needed"""
+        seq = message["seq"]
+        newest = self.track(seq)
+        if message["frame"] == FRAME_KEY:
+            self.keyframes[seq] = message
+            while len(self.keyframes) > KEPT_KEYFRAMES:
+                del self.keyframes[min(self.keyframes)]
+            records = [(seq, rebuild(message, {}))]
+            parked = self.parked.pop(seq, [])
+            self.parked_count -= len(parked)
+            records += [(delta["seq"], rebuild(message, delta)) for delta in parked]
+            return records, False
+        keyframe = self.keyframes.get(message["key_seq"])
+        if keyframe:
+            return [(seq, rebuild(keyframe, message))], False
+        if self.parked_count < MAX_PARKED:
+            self.parked.setdefault(message["key_seq"], []).append(message)
+            self.parked_count += 1
+        # Older deltas come before their keyframe when an outbox backlog is sent newest first
+        return [], newest
+
+
+def accept_encoding() -> str:
+    """Accept-Encoding of 415 answers (RFC 7694), tells the sender whether the encoding was refused"""
+    if not settings["compression"]:
+        return "identity"
+    return "gzip, zstd" if zstandard else "gzip"
+
+
+def decompress(body: bytes, encoding: str):
+    """Request body without its Content-Encoding, None when the encoding is not supported"""
+    if not encoding or encoding == "identity":
+        return body
+    if not settings["compression"]:
+        return None
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "zstd" and zstandard:
+        # Frames written by compress() carry their content size
+        return zstandard.ZstdDecompressor().decompress(body)
+    return None
+
+
+def reset_stats():
+    with stats_lock:
+        stats.update(uploads=0, upload_bytes=0, upload_failures=0, influx_writes=0, influx_lines=0, influx_bytes=0,
+                     packed_uploads=0, packed_refused=0,
+                     compressed_uploads=0, compression_refused=0, decompressed_bytes=0, keyframes=0, deltas=0, records=0, keyframe_requests=0, started=time.time())
+        streams.clear()
+
+
+reset_stats()
+
+
 @app.route('/upload', methods=['POST'])
+@app.route('/goodweht/saveinverterdata/v1.0', methods=['POST'])
 def upload():
-    json_data = request.get_json()
-    print(json_data)
-    return 'OK', 200
+    if settings["latency"]:
+        time.sleep(settings["latency"])
+    if settings["fail_rate"] and random.random() < settings["fail_rate"]:
+        with stats_lock:
+            stats["upload_failures"] += 1
+        return 'Simulated failure', 500
+    wire_bytes = request.get_data()
+    encoding = request.headers.get("Content-Encoding", "").strip().lower()
+    try:
+        body = decompress(wire_bytes, encoding)
+    except DECOMPRESS_ERRORS as e:
+        return f'Invalid {encoding} body: {e}', 400
+    if body is None:
+        with stats_lock:
+            stats["compression_refused"] += 1
+        return 'Unsupported content encoding', 415, {"Accept-Encoding": accept_encoding()}
+    content_type = request.headers.get("Content-Type", "")
+    packed = content_type.startswith(PACKED_CONTENT_TYPE)
+    if packed:
+        if not settings["packed"] or not codec.accepts(content_type):
+            with stats_lock:
+                stats["packed_refused"] += 1
+            return 'Unsupported record format', 415, {"Accept-Encoding": accept_encoding()}
+        try:
+            json_data = codec.unpack(body)
+        except (ValueError, UnicodeDecodeError, struct.error) as e:
+            return f'Invalid record: {e}', 400
+    else:
+        try:
+            json_data = json.loads(body)
+        except ValueError as e:
+            return f'Invalid JSON: {e}', 400
+    keyframe_needed = False
+    with stats_lock:
+        stats["uploads"] += 1
+        if packed:
+            stats["packed_uploads"] += 1
+        stats["upload_bytes"] += len(wire_bytes)
+        if body is not wire_bytes:
+            stats["compressed_uploads"] += 1
+            stats["decompressed_bytes"] += len(body)
+        if json_data.get("frame") in (FRAME_KEY, FRAME_DELTA):
+            stats["keyframes" if json_data["frame"] == FRAME_KEY else "deltas"] += 1
+            stream = streams.setdefault((json_data["plant"], json_data["slave_address"]), Stream())
+            records, keyframe_needed = stream.receive(json_data)
+            for seq, record in records:
+                stream.add_record(seq, record)
+            if keyframe_needed:
+                stats["keyframe_requests"] += 1
+        else:
+            records = [(None, json_data)]
+        stats["records"] += len(records)
+    if not settings["quiet"]:
+        for _, record in records:
+            print(record)
+    headers = {KEYFRAME_REQUEST_HEADER: str(json_data["slave_address"])} if keyframe_needed else {}
+    return 'OK', 200, headers
+
+
+@app.route('/api/v2/write', methods=['POST'])
+def influx_write():
+    body = request.get_data()
+    with stats_lock:
+        stats["influx_writes"] += 1
+        stats["influx_lines"] += body.count(b"\n") + (1 if body and not body.endswith(b"\n") else 0)
+        stats["influx_bytes"] += len(body)
+    return '', 204
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    with stats_lock:
+        return jsonify({**stats, "missing_seq": sum(stream.missing() for stream in streams.values()),
+                        "parked_deltas": sum(stream.parked_count for stream in streams.values())})
+
+
+@app.route('/records', methods=['GET'])
+def get_records():
+    with stats_lock:
+        return jsonify({f"{plant}/{slave}": stream.latest for (plant, slave), stream in streams.items()})
+
+
+@app.route('/stats', methods=['DELETE'])
+def delete_stats():
+    reset_stats()
+    return '', 204
+
+
+def main(port: int = 5000):
+    app.run(port=port)
+
 
-def main():
-    app.run(port=5000)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cloud service and InfluxDB stand-in")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--quiet", action="store_true", help="do not print received messages")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay of every cloud response in seconds")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="part of cloud uploads failed with 500")
+    parser.add_argument("--no-packed", action="store_true", help="refuse packed binary records with 415")
+    parser.add_argument("--no-compression", action="store_true", help="refuse compressed bodies with 415")
+    args = parser.parse_args()
+    settings.update(quiet=args.quiet, latency=args.latency, fail_rate=args.fail_rate, packed=not args.no_packed,
+                    compression=not args.no_compression)
+    if args.quiet:
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    app.run(port=args.port, threaded=True)
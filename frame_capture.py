@@ -0,0 +1,90 @@
+import logging
+import os
+import struct
+from typing import Iterator, List
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"JCAP"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sH")
+# timestamp (epoch sec), slave, start address, register count, followed by count uint16 words
+RECORD_HEADER = struct.Struct("<dBHH")
+MAX_CAPTURE_BYTES = 100 * 1024 * 1024
+
+
+class CapturedBlock:
+    def __init__(self, timestamp: float, slave: int, address: int, registers: List[int]):
+        self.timestamp = timestamp
+        self.slave = slave
+        self.address = address
+        self.registers = registers
+
+    def __str__(self):
+        return f"{self.timestamp:.3f} slave {self.slave} {self.address}+{len(self.registers)}"
+
+
+class FrameCapture:
+    """Appends raw register blocks read from invertors to a compact binary log
+
+    Record is 13 bytes header plus 2 bytes per register, one 5 minute cycle of
+    4 invertors is about 1.2 kB. Capture stops when the file reaches max_bytes.
+    """
+    def __init__(self, path: str, max_bytes: int = MAX_CAPTURE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.file = None
+        self.size = 0
+        self.full = False
+
+    def open(self):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.file = open(self.path, "ab")
+        if new_file:
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.size = self.file.tell()
+        log.info(f"Capturing register blocks to {self.path}, {self.size} bytes")
+
+    def append(self, slave: int, address: int, registers: List[int], timestamp: float):
+        if self.full:
+            return
+        if self.file is None:
+            self.open()
+        record = RECORD_HEADER.pack(timestamp, slave, address, len(registers)) + struct.pack(f"<{len(registers)}H", *registers)
+        if self.size + len(record) > self.max_bytes:
+            log.warning(f"Capture file {self.path} reached {self.max_bytes} bytes, capture stopped")
+            self.full = True
+            return
+        # Buffered write, goes to disk on flush at the end of the cycle
+        self.file.write(record)
+        self.size += len(record)
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def read_capture(path: str) -> Iterator[CapturedBlock]:
+    with open(path, "rb") as f:
+        header = f.read(FILE_HEADER.size)
+        magic, version = FILE_HEADER.unpack(header) if len(header) == FILE_HEADER.size else (None, None)
+        if magic != MAGIC or version != VERSION:
+            raise Exception(f"{path} is not a register capture version {VERSION}")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                log.warning(f"Truncated record at the end of {path}")
+                return
+            timestamp, slave, address, count = RECORD_HEADER.unpack(header)
+            data = f.read(2 * count)
+            if len(data) < 2 * count:
+                log.warning(f"Truncated record at the end of {path}")
+                return
+            yield CapturedBlock(timestamp, slave, address, list(struct.unpack(f"<{count}H", data)))
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Goodwe HT invertor simulator, N virtual slaves on one Modbus RTU bus
+Serves a pty pair (default, prints the device for config.serial_device) or RTU over TCP.
+Usage: python goodwe_simulator.py [--slaves N] [--tcp PORT] [--link /tmp/ttySim]
+                                  [--latency SEC] [--jitter SEC] [--dropout P] [--bad-crc P]
+                                  [--baudrate 9600] [--time-scale X]
+Example: python goodwe_simulator.py --slaves 20 --link /tmp/ttySim --latency 0.05 --jitter 0.02 --dropout 0.01
+"""
+
+import argparse
+import asyncio
+import datetime
+import logging
+import math
+import os
+import random
+import time
+import tty
+
+from pymodbus.datastore import ModbusServerContext, ModbusSequentialDataBlock, ModbusSlaveContext
+from pymodbus.exceptions import NoSuchSlaveException
+from pymodbus.factory import ServerDecoder
+from pymodbus.framer import Framer, ModbusRtuFramer
+from pymodbus.server import ModbusSerialServer, ModbusTcpServer
+
+from adaptive_timeout import frame_time, read_frame_chars, write_frame_chars
+from registers_goodwe_ht import GoodweHTRegs, RegName
+
+log = logging.getLogger(__name__)
+
+NOMINAL_POWER_KW = 110
+PV_STRINGS = 20 # strings connected, the rest of the 24 inputs reads 0
+STRING_VOLTAGE = 620.0
+GRID_PHASE_VOLTAGE = 230.0
+SUNRISE_HOUR = 6.0
+SUNSET_HOUR = 20.0
+CLOUD_STEP = 0.05 # random walk step of cloud cover per simulated minute
+UPDATE_SEC = 1.0 # register image is recomputed at most once per simulated second
+REGISTER_SPACE = 42000
+OPER_STATUS_WAITING = 0
+OPER_STATUS_NORMAL = 1
+
+
+class FaultProfile:
+    """Bus behaviour of one virtual slave"""
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, dropout: float = 0.0, bad_crc: float = 0.0):
+        self.latency = latency # slave turnaround in seconds
+        self.jitter = jitter # uniform 0..jitter added to latency
+        self.dropout = dropout # probability of no response
+        self.bad_crc = bad_crc # probability of a response with broken CRC
+
+
+class SimulatedInvertor:
+    """Time varying values of one Goodwe HT, power follows a clear sky curve with clouds"""
+    def __init__(self, slave: int, nominal_power: float = NOMINAL_POWER_KW, time_scale: float = 1.0, seed: int = None):
+        self.slave = slave
+        self.nominal_power = nominal_power
+        self.time_scale = time_scale
+        self.random = random.Random(seed if seed is not None else slave)
+        self.started = time.time()
+        self.clouds = 0.0
+        self.sim_time = None
+        self.cumulative_energy = self.random.uniform(100000, 500000) # kWh
+        self.day_energy = 0.0
+        self.day = None
+        self.peak_power_day = 0.0
+        self.regs = GoodweHTRegs()
+        self.regs.set_value(RegName.SERIAL_NUMBER, f"SIMHT{slave:011d}")
+
+    def clock(self) -> datetime.datetime:
+        """Simulated local time, runs time_scale times faster than the wall clock"""
+        return datetime.datetime.fromtimestamp(self.started + (time.time() - self.started) * self.time_scale)
+
+    def irradiance(self, now: datetime.datetime) -> float:
+        hour = now.hour + now.minute / 60 + now.second / 3600
+        if not SUNRISE_HOUR < hour < SUNSET_HOUR:
+            return 0.0
+        clear_sky = math.sin(math.pi * (hour - SUNRISE_HOUR) / (SUNSET_HOUR - SUNRISE_HOUR))
+        return clear_sky * (1.0 - 0.7 * self.clouds)
+
+    def update(self, power_adjust: int):
+        """Advance the model to the simulated clock, power is capped by power adjust in kW"""
+        now = self.clock()
+        elapsed = (now - self.sim_time).total_seconds() if self.sim_time else 0.0
+        if self.sim_time is not None and elapsed < UPDATE_SEC:
+            return
+        self.sim_time = now
+        if self.day != now.date():
+            self.day = now.date()
+            self.day_energy = 0.0
+            self.peak_power_day = 0.0
+        minutes = elapsed / 60
+        self.clouds = min(1.0, max(0.0, self.clouds + self.random.gauss(0, CLOUD_STEP * math.sqrt(max(minutes, 0.01)))))
+
+        regs = self.regs
+        irradiance = self.irradiance(now)
+        string_power = self.nominal_power * 1000 / PV_STRINGS * irradiance * 1.03 # W, a bit of DC oversizing
+        input_power = 0.0
+        for i in range(1, 25):
+            voltage = current = 0.0
+            if i <= PV_STRINGS and irradiance > 0:
+                voltage = STRING_VOLTAGE * (0.9 + 0.1 * irradiance) + self.random.uniform(-3, 3)
+                current = max(0.0, string_power * self.random.uniform(0.97, 1.03) / voltage)
+            regs.set_value(getattr(RegName, f"PV{i}_U"), voltage)
+            regs.set_value(getattr(RegName, f"PV{i}_C"), current)
+            input_power += voltage * current / 1000
+
+        efficiency = 98.4 if input_power > 0 else 0.0
+        active_power = min(input_power * efficiency / 100, self.nominal_power, max(0, power_adjust))
+        producing = active_power > 0
+        self.cumulative_energy += active_power * elapsed / 3600
+        self.day_energy += active_power * elapsed / 3600
+        self.peak_power_day = max(self.peak_power_day, active_power)
+
+        phase_voltage = GRID_PHASE_VOLTAGE + self.random.uniform(-2, 2)
+        phase_current = active_power * 1000 / (3 * phase_voltage)
+        regs.set_value(RegName.OPER_STATUS, OPER_STATUS_NORMAL if producing else OPER_STATUS_WAITING)
+        regs.set_value(RegName.INPUT_POWER, input_power)
+        for name in (RegName.GRID_AB_VOLTAGE, RegName.GRID_BC_VOLTAGE, RegName.GRID_CA_VOLTAGE):
+            regs.set_value(name, phase_voltage * math.sqrt(3))
+        for name in (RegName.GRID_A_VOLTAGE, RegName.GRID_B_VOLTAGE, RegName.GRID_C_VOLTAGE):
+            regs.set_value(name, phase_voltage)
+        for name in (RegName.GRID_A_CURRENT, RegName.GRID_B_CURRENT, RegName.GRID_C_CURRENT):
+            regs.set_value(name, phase_current * self.random.uniform(0.99, 1.01))
+        regs.set_value(RegName.PEAK_ACTIVE_POWER_DAY, self.peak_power_day)
+        regs.set_value(RegName.ACTIVE_POWER, active_power)
+        regs.set_value(RegName.REACTIVE_POWER, 0.0)
+        regs.set_value(RegName.POWER_FACTOR, 0.999 if producing else 0.0)
+        regs.set_value(RegName.GRID_FREQUENCY, 50.0 + self.random.uniform(-0.02, 0.02))
+        regs.set_value(RegName.INVERTER_EFFICIENCY, efficiency)
+        regs.set_value(RegName.INTERNAL_TEMPERATURE, 25.0 + 20.0 * active_power / self.nominal_power)
+        regs.set_value(RegName.CUMULATIVE_POWER_GENERATION, self.cumulative_energy)
+        regs.set_value(RegName.POWER_GENERATION_DAY, self.day_energy)
+        regs.set_value(RegName.POWER_GENERATION_MONTH, self.day_energy + 30 * self.nominal_power * 4 * now.day / 31)
+        regs.set_value(RegName.POWER_GENERATION_YEAR, self.day_energy + 30 * self.nominal_power * 4 * now.month)
+        regs.set_value(RegName.ACTIVE_POWER_CALCULATION, active_power)
+        regs.set_value(RegName.RTC_YEAR_MONTH, (now.year % 100) << 8 | now.month)
+        regs.set_value(RegName.RTC_DAY_HOUR, now.day << 8 | now.hour)
+        regs.set_value(RegName.RTC_MINUTE_SECOND, now.minute << 8 | now.second)
+
+    def registers(self):
+        """(address, words) of every register except power adjust, which belongs to the master"""
+        for name, reg in self.regs.regs.items():
+            if name != RegName.POWER_ADJUST:
+                yield reg.address, self.regs.encode(reg.address, reg.address)
+
+
+class SimulatedSlaveContext(ModbusSlaveContext):
+    """Register image of one virtual invertor with response latency and dropouts"""
+    def __init__(self, invertor: SimulatedInvertor, faults: FaultProfile, baudrate: int = None):
+        super().__init__(hr=ModbusSequentialDataBlock(0, [0] * REGISTER_SPACE), zero_mode=True)
+        self.invertor = invertor
+        self.faults = faults
+        self.baudrate = baudrate
+        self.requests = 0
+        self.dropped = 0
+        address = invertor.regs.get(RegName.POWER_ADJUST).address
+        self.power_adjust_address = address
+        self.setValues(3, address, [int(invertor.nominal_power)])
+
+    async def respond_delay(self, chars: int):
+        self.requests += 1
+        delay = self.faults.latency + random.uniform(0, self.faults.jitter)
+        if self.baudrate:
+            # Pty and TCP are instant, real bus spends time on the wire
+            delay += frame_time(self.baudrate, chars)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.faults.dropout and random.random() < self.faults.dropout:
+            self.dropped += 1
+            # Server configured to ignore missing slaves sends no response
+            raise NoSuchSlaveException(f"Simulated dropout of slave {self.invertor.slave}")
+
+    async def async_getValues(self, fc_as_hex: int, address: int, count: int = 1):
+        await self.respond_delay(read_frame_chars(count))
+        self.invertor.update(self.getValues(3, self.power_adjust_address, 1)[0])
+        for reg_address, words in self.invertor.registers():
+            self.setValues(3, reg_address, words)
+        return self.getValues(fc_as_hex, address, count)
+
+    async def async_setValues(self, fc_as_hex: int, address: int, values):
+        try:
+            await self.respond_delay(write_frame_chars(len(values)))
+        finally:
+            # Write is applied even when its response is lost
+            self.setValues(fc_as_hex, address, values)
+
+
+class GoodweSimulator:
+    def __init__(self, slaves: list[int], faults: FaultProfile, time_scale: float = 1.0, baudrate: int = None, nominal_power: float = NOMINAL_POWER_KW):
+        self.contexts = {
+            slave: SimulatedSlaveContext(SimulatedInvertor(slave, nominal_power, time_scale), faults, baudrate)
+            for slave in slaves
+        }
+        self.context = ModbusServerContext(slaves=self.contexts, single=False)
+        self.framer = ModbusRtuFramer(ServerDecoder(), client=None)
+        self.server = None
+        self.bad_frames = 0
+
+    def corrupt_response(self, response):
+        """Server response_manipulator, breaks CRC of a part of the responses"""
+        context = self.contexts.get(response.slave_id)
+        if context is None or not context.faults.bad_crc or random.random() >= context.faults.bad_crc:
+            return response, False
+        self.bad_frames += 1
+        packet = bytearray(self.framer.buildPacket(response))
+        packet[-1] ^= 0xFF
+        return bytes(packet), True
+
+    def server_kwargs(self) -> dict:
+        return dict(framer=Framer.RTU, ignore_missing_slaves=True, broadcast_enable=True, response_manipulator=self.corrupt_response)
+
+    async def serve_serial(self, port: str):
+        self.server = ModbusSerialServer(self.context, port=port, baudrate=9600, **self.server_kwargs())
+        await self.server.serve_forever()
+
+    async def serve_tcp(self, port: int, host: str = "0.0.0.0"):
+        # RTU framing over TCP, as the serial gateway used with socat in the monitor
+        self.server = ModbusTcpServer(self.context, address=(host, port), **self.server_kwargs())
+        await self.server.serve_forever()
+
+    async def shutdown(self):
+        if self.server:
+            await self.server.shutdown()
+
+    def stats(self) -> str:
+        requests = sum(context.requests for context in self.contexts.values())
+        dropped = sum(context.dropped for context in self.contexts.values())
+        return f"{len(self.contexts)} slaves, {requests} requests, {dropped} dropped, {self.bad_frames} bad CRC"
+
+
+def pty_pair():
+    """Two connected raw ptys, returns (server device, client device)
+
+    Bytes are copied between the pty masters by the event loop, so the simulator
+    must run in the same loop as long as the pair is used.
+    """
+    master_a, slave_a = os.openpty()
+    master_b, slave_b = os.openpty()
+    for fd in (slave_a, slave_b):
+        tty.setraw(fd)
+    loop = asyncio.get_running_loop()
+
+    def forward(source, target):
+        def copy():
+            try:
+                os.write(target, os.read(source, 4096))
+            except OSError:
+                pass
+        return copy
+
+    loop.add_reader(master_a, forward(master_a, master_b))
+    loop.add_reader(master_b, forward(master_b, master_a))
+    return os.ttyname(slave_a), os.ttyname(slave_b)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Goodwe HT invertor simulator")
+    parser.add_argument("--slaves", type=int, default=4, help="number of invertors, slave addresses from 1")
+    parser.add_argument("--tcp", type=int, help="serve RTU over TCP on this port instead of a pty")
+    parser.add_argument("--link", help="symlink to the client pty, e.g. /tmp/ttySim")
+    parser.add_argument("--latency", type=float, default=0.05, help="slave turnaround in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="max random addition to latency in seconds")
+    parser.add_argument("--dropout", type=float, default=0.0, help="probability of no response")
+    parser.add_argument("--bad-crc", type=float, default=0.0, help="probability of a response with bad CRC")
+    parser.add_argument("--baudrate", type=int, help="add wire time of this line speed to every response")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="simulated day runs this many times faster")
+    parser.add_argument("--nominal-power", type=float, default=NOMINAL_POWER_KW)
+    args = parser.parse_args()
+
+    faults = FaultProfile(args.latency, args.jitter, args.dropout, args.bad_crc)
+    simulator = GoodweSimulator(list(range(1, args.slaves + 1)), faults, args.time_scale, args.baudrate, args.nominal_power)
+
+    async def log_stats():
+        while True:
+            await asyncio.sleep(60)
+            log.info(simulator.stats())
+
+    stats_task = asyncio.create_task(log_stats())
+    try:
+        if args.tcp:
+            log.info(f"Simulating {args.slaves} invertors on RTU over TCP port {args.tcp}")
+            await simulator.serve_tcp(args.tcp)
+        else:
+            server_device, client_device = pty_pair()
+            if args.link:
+                if os.path.islink(args.link):
+                    os.unlink(args.link)
+                os.symlink(client_device, args.link)
+                client_device = args.link
+            log.info(f"Simulating {args.slaves} invertors, set serial_device = \"{client_device}\"")
+            await simulator.serve_serial(server_device)
+    finally:
+        stats_task.cancel()
+        log.info(simulator.stats())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+    asyncio.run(main())
@@ -1,9 +1,11 @@
 from influxdb_client import InfluxDBClient, Point
 from influxdb_client.client.write_api import SYNCHRONOUS
 import logging
+import time
 from datetime import datetime, timezone
 
 from invertor import Invertor
+from metrics import Counter, Histogram
 from registers_goodwe_ht import GoodweHTRegs, RegName
 
 log = logging.getLogger(__name__)
@@ -16,88 +18,14 @@ class InfluxWriter:
         self.bucket = bucket
         self.client = InfluxDBClient(url=url, token=token, org=org)
         self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+        self.latency = Histogram("influx_write_seconds", "Synchronous write of one invertor reading to InfluxDB")
+        self.failures = Counter("influx_write_failures_total", "InfluxDB writes failed")
         
-    def write_regs(self, regs: GoodweHTRegs, invertor: Invertor):
+    def write_regs(self, regs: GoodweHTRegs, invertor: Invertor, timestamp: datetime = None):
         """Write PV power values to InfluxDB measurement 'power'"""
+        started = time.monotonic()
         try:
-            points = []
-            timestamp = datetime.now(timezone.utc)
-            
-            # Write power for all PV1-PV24
-            for i in range(1, 25):
-                pv_u_name = getattr(RegName, f"PV{i}_U")
-                pv_c_name = getattr(RegName, f"PV{i}_C")
-                
-                pv_voltage = regs.get_value(pv_u_name)
-                pv_current = regs.get_value(pv_c_name)
-                pv_power = pv_voltage * pv_current
-                
-                # Create power point for each PV
-                power_point = Point("power") \
-                    .tag("invertor_no", f"inv{invertor.invertor_no}") \
-                    .tag("pv", f"pv{i}") \
-                    .field("value", pv_power) \
-                    .time(timestamp)
-                points.append(power_point)
-            
-            # Write additional power measurements
-            additional_powers = [
-                ("input_power", RegName.INPUT_POWER),
-                ("active_power", RegName.ACTIVE_POWER),
-                ("reactive_power", RegName.REACTIVE_POWER)
-            ]
-            
-            for power_type, reg_name in additional_powers:
-                power_value = regs.get_value(reg_name)
-                power_point = Point("power") \
-                    .tag("invertor_no", f"inv{invertor.invertor_no}") \
-                    .tag("pv", power_type) \
-                    .field("value", power_value) \
-                    .time(timestamp)
-                points.append(power_point)
-            
-            # Write grid voltage data
-            grid_voltages = [
-                ("grid_a", RegName.GRID_A_VOLTAGE),
-                ("grid_b", RegName.GRID_B_VOLTAGE),
-                ("grid_c", RegName.GRID_C_VOLTAGE)
-            ]
-            
-            for phase_name, reg_name in grid_voltages:
-                voltage_value = regs.get_value(reg_name)
-                voltage_point = Point("grid_voltages2") \
-                    .tag("invertor_no", f"inv{invertor.invertor_no}") \
-                    .tag("phase", phase_name) \
-                    .field("value", voltage_value) \
-                    .time(timestamp)
-                points.append(voltage_point)
-            
-            # Write grid current data
-            grid_currents = [
-                ("grid_a", RegName.GRID_A_CURRENT),
-                ("grid_b", RegName.GRID_B_CURRENT),
-                ("grid_c", RegName.GRID_C_CURRENT)
-            ]
-            
-            for phase_name, reg_name in grid_currents:
-                current_value = regs.get_value(reg_name)
-                current_point = Point("grid_current") \
-                    .tag("invertor_no", f"inv{invertor.invertor_no}") \
-                    .tag("phase", phase_name) \
-                    .field("value", current_value) \
-                    .time(timestamp)
-                points.append(current_point)
-            
-            # Write stats data as a single point with multiple fields
-            stats_point = Point("stats") \
-                .tag("invertor_no", f"inv{invertor.invertor_no}") \
-                .field("power_factor", regs.get_value(RegName.POWER_FACTOR)) \
-                .field("grid_frequency", regs.get_value(RegName.GRID_FREQUENCY)) \
-                .field("inverter_efficiency", regs.get_value(RegName.INVERTER_EFFICIENCY)) \
-                .field("internal_temperature", regs.get_value(RegName.INTERNAL_TEMPERATURE)) \
-                .field("power_adjust", invertor.power_adjust) \
-                .time(timestamp)
-            points.append(stats_point)
+            points = self.build_points(regs, invertor, timestamp)
             
             # Write all points to InfluxDB
             self.write_api.write(bucket=self.bucket, record=points)
@@ -105,7 +33,94 @@ class InfluxWriter:
             
         except Exception as e:
             log.error(f"Error writing to InfluxDB: {e}")
+            self.failures.inc()
             raise
+        finally:
+            self.latency.observe(time.monotonic() - started)
+
+    @staticmethod
+    def build_points(regs: GoodweHTRegs, invertor: Invertor, timestamp: datetime = None) -> list:
+        """Points of one invertor reading, no I/O"""
+        points = []
+        if timestamp is None:
+            timestamp = datetime.now(timezone.utc)
+        
+        # Write power for all PV1-PV24
+        for i in range(1, 25):
+            pv_u_name = getattr(RegName, f"PV{i}_U")
+            pv_c_name = getattr(RegName, f"PV{i}_C")
+            
+            pv_voltage = regs.get_value(pv_u_name)
+            pv_current = regs.get_value(pv_c_name)
+            pv_power = pv_voltage * pv_current
+            
+            # Create power point for each PV
+            power_point = Point("power") \
+                .tag("invertor_no", f"inv{invertor.invertor_no}") \
+                .tag("pv", f"pv{i}") \
+                .field("value", pv_power) \
+                .time(timestamp)
+            points.append(power_point)
+        
+        # Write additional power measurements
+        additional_powers = [
+            ("input_power", RegName.INPUT_POWER),
+            ("active_power", RegName.ACTIVE_POWER),
+            ("reactive_power", RegName.REACTIVE_POWER)
+        ]
+        
+        for power_type, reg_name in additional_powers:
+            power_value = regs.get_value(reg_name)
+            power_point = Point("power") \
+                .tag("invertor_no", f"inv{invertor.invertor_no}") \
+                .tag("pv", power_type) \
+                .field("value", power_value) \
+                .time(timestamp)
+            points.append(power_point)
+        
+        # Write grid voltage data
+        grid_voltages = [
+            ("grid_a", RegName.GRID_A_VOLTAGE),
+            ("grid_b", RegName.GRID_B_VOLTAGE),
+            ("grid_c", RegName.GRID_C_VOLTAGE)
+        ]
+        
+        for phase_name, reg_name in grid_voltages:
+            voltage_value = regs.get_value(reg_name)
+            voltage_point = Point("grid_voltages2") \
+                .tag("invertor_no", f"inv{invertor.invertor_no}") \
+                .tag("phase", phase_name) \
+                .field("value", voltage_value) \
+                .time(timestamp)
+            points.append(voltage_point)
+        
+        # Write grid current data
+        grid_currents = [
+            ("grid_a", RegName.GRID_A_CURRENT),
+            ("grid_b", RegName.GRID_B_CURRENT),
+            ("grid_c", RegName.GRID_C_CURRENT)
+        ]
+        
+        for phase_name, reg_name in grid_currents:
+            current_value = regs.get_value(reg_name)
+            current_point = Point("grid_current") \
+                .tag("invertor_no", f"inv{invertor.invertor_no}") \
+                .tag("phase", phase_name) \
+                .field("value", current_value) \
+                .time(timestamp)
+            points.append(current_point)
+        
+        # Write stats data as a single point with multiple fields
+        stats_point = Point("stats") \
+            .tag("invertor_no", f"inv{invertor.invertor_no}") \
+            .field("power_factor", regs.get_value(RegName.POWER_FACTOR)) \
+            .field("grid_frequency", regs.get_value(RegName.GRID_FREQUENCY)) \
+            .field("inverter_efficiency", regs.get_value(RegName.INVERTER_EFFICIENCY)) \
+            .field("internal_temperature", regs.get_value(RegName.INTERNAL_TEMPERATURE)) \
+            .field("power_adjust", invertor.power_adjust) \
+            .time(timestamp)
+        points.append(stats_point)
+        return points
     
     def close(self):
         """Close the InfluxDB client connection"""
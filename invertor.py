@@ -1,8 +1,43 @@
+import time
+
+OPER_STATUS_NORMAL = 1 # operation status of an invertor feeding the grid
+
+
 class Invertor:
-    def __init__(self, invertor_no: int, slave_address: int):
+    def __init__(self, invertor_no: int, slave_address: int, nominal_power: int = None):
         self.invertor_no = invertor_no
         self.slave_address = slave_address
+        self.nominal_power = nominal_power # kW
         self.power_adjust = None
+        self.power_adjust_read_at = None # monotonic time power_adjust was last confirmed on device
+        self.power_adjust_retry_at = 0.0
+        self.oper_status = None
+        self.active_power = 0.0 # kW, from last monitoring read
+        self.active_power_at = None
+        self.active_power_setpoint = None # power adjust in force when active power was read
+
+    def set_power_adjust(self, power_adjust: int):
+        self.power_adjust = power_adjust
+        self.power_adjust_read_at = time.monotonic()
+
+    def invalidate_power_adjust(self):
+        """Keep cached value for regulation, but revalidate it on next monitoring read"""
+        self.power_adjust_read_at = None
+
+    def power_adjust_expired(self, ttl_sec: float) -> bool:
+        return self.power_adjust_read_at is None or time.monotonic() - self.power_adjust_read_at > ttl_sec
+
+    def set_active_power(self, active_power: float):
+        self.active_power = active_power
+        self.active_power_at = time.monotonic()
+        self.active_power_setpoint = self.power_adjust
+
+    def invalidate_active_power(self):
+        """Monitoring read failed, live power is unknown"""
+        self.active_power_at = None
+
+    def producing(self) -> bool:
+        return self.oper_status is None or self.oper_status == OPER_STATUS_NORMAL
 
     def __str__(self):
         return f"Slave: {self.slave_address}"
@@ -1,28 +1,68 @@
 import asyncio
+import contextlib
 import datetime
-import json
 import logging
+import signal
+import time
 from typing import List
 
 from pymodbus.client import AsyncModbusSerialClient
 from pymodbus.constants import Endian
 from pymodbus.payload import BinaryPayloadDecoder, BinaryPayloadBuilder
 
-from cloud_sender import CloudSender
-from common import setup_logging
+from adaptive_timeout import RttEstimator, frame_time, read_frame_chars, write_frame_chars
+from baud_commissioning import BaudNegotiator, load_baudrate
+from bus_arbiter import BusArbiter, BusDeadlineExceeded, BusPriority
+from cloud_sender import CloudSender, COMPRESSION_MIN_BYTES, WIRE_FORMAT_JSON
+from common import LOG_BACKUPS, LOG_MAX_BYTES, setup_logging
 from config import Config
+from cycle_profile import CycleProfiler, PROFILE_LOG
 from event_sender import EventSender
+from frame_capture import FrameCapture
 from influx import InfluxWriter
 from invertor import Invertor
+from loop_monitor import LoopMonitor, STALL_THRESHOLD_SEC
 from mailer import Mailer
+from message_encoder import DeltaEncoder, KEYFRAME_INTERVAL, MessageEncoder
+from metrics import Counter, Gauge, Histogram, Registry
+from metrics_server import MetricsServer
 from msgdb import MsgDb, Msg
-from registers_goodwe_ht import GoodweHTRegs, RegName, RegType
+from plant_controller import DEADBAND_KW, PlantController
+from registers_goodwe_ht import GoodweHTRegs, RegName
 from rtu_monitor import RtuMonitor
 
 log = logging.getLogger(__name__)
+# Per cycle dumps of every invertor, rate limited by config.log_rate_limits
+regs_log = logging.getLogger("invertor_regs")
+json_log = logging.getLogger("invertor_json")
 
-HT_NOMINAL_POWER = 110 # kW
+HT_NOMINAL_POWER = 110 # kW, default when not set in config.invertor_nominal_power
 ROUND_SEC = 300 
+OUTBOX_DRAIN_MAX = 200 # messages sent per cycle, the rest waits for the next one
+# Register blocks read from every invertor in each monitoring cycle
+READ_BLOCKS = [
+    (RegName.OPER_STATUS, RegName.OPER_STATUS),
+    (RegName.PV1_U, RegName.INTERNAL_TEMPERATURE),
+    (RegName.CUMULATIVE_POWER_GENERATION, RegName.POWER_GENERATION_YEAR),
+    (RegName.SERIAL_NUMBER, RegName.SERIAL_NUMBER),
+    (RegName.RTC_YEAR_MONTH, RegName.RTC_MINUTE_SECOND),
+]
+REGULATION_POLL_SEC = 0.5
+REGULATION_RETRY_SEC = 60
+POWER_ADJUST_TTL_SEC = 3600
+SERIAL_BAUDRATE = 9600 # default when not set in config.serial_baudrate
+BAUD_FALLBACK_ERROR_RATE = 0.2
+BAUD_FALLBACK_MIN_REQUESTS = 10
+BAUD_NEGOTIATION_INTERVAL_SEC = 3600
+# pymodbus own timeout and retries are only a safety net, each transaction gets
+# timeout from per slave RTT estimate and retries from the block retry budget
+CLIENT_TIMEOUT_SEC = 10
+BLOCK_RETRIES = 2
+BROADCAST_SLAVE = 0
+BROADCAST_TURNAROUND_SEC = 0.2 # slaves get time to process broadcast before next request
+METRICS_HOST = "0.0.0.0"
+CYCLE_BUCKETS = (1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+SHUTDOWN_TIMEOUT_SEC = 8 # docker stop kills the container 10 sec after SIGTERM
 
 
 class GoodweHTSet:
@@ -34,13 +74,75 @@ class GoodweHTSet:
         self.event_sender: EventSender = event_sender
         self.cloud_sender: CloudSender = cloud_sender
         self.regs = GoodweHTRegs() # only for addressing purposes, not for data
+        self.encoder = MessageEncoder(self.regs, getattr(config, "json_fast_backend", True))
+        # Keyframes and deltas instead of full messages, the receiver must support it
+        self.delta_encoder = None
+        if getattr(config, "cloud_delta_enable", False):
+            self.delta_encoder = DeltaEncoder(getattr(config, "cloud_keyframe_interval", KEYFRAME_INTERVAL))
         self.db = MsgDb()
+        # Raw register blocks for replay (capture_replay.py), off unless config.capture_file is set
+        capture_file = getattr(config, "capture_file", None)
+        self.capture = FrameCapture(capture_file) if capture_file else None
+        self.client = None
+        # Serializes transactions on the RS485 bus, control traffic goes ahead of monitoring reads
+        self.bus = BusArbiter("rs485")
+        self.rtt = {invertor.slave_address: RttEstimator() for invertor in self.invertors}
+        # Speed found by commissioning wins over configured one
+        self.baudrate = load_baudrate(config.serial_device) or getattr(config, "serial_baudrate", SERIAL_BAUDRATE)
+        self.baud_negotiated_at = None
+        self.cycle_errors = {}  # slave -> [requests, failures] in the current monitoring cycle
+        self.regulation_task = None
+        # Set when RTU inputs change outside of the regulation poll (heartbeat)
+        self.regulation_wakeup = asyncio.Event()
+        self.plant_controller = None
+        if getattr(config, "plant_controller_enable", False):
+            self.plant_controller = PlantController(getattr(config, "plant_controller_deadband", DEADBAND_KW))
+        self.regulation_latency = Histogram("regulation_reaction_seconds", "RTU change detected to all invertors updated")
+        # Stage timing of each cycle, records go to config.profile_log (None keeps them in memory only)
+        self.profiler = CycleProfiler(getattr(config, "profile_log", PROFILE_LOG))
+        # Operational metrics, served on config.metrics_port when set
+        self.metrics = Registry()
+        self.metrics_server = None
+        self.loop_monitor = LoopMonitor(threshold=getattr(config, "loop_stall_threshold_sec", STALL_THRESHOLD_SEC))
+        self.modbus_latency = Histogram("modbus_read_seconds", "Register block read including bus wait and retries", labelnames=("slave", "block"))
+        self.modbus_timeouts = Counter("modbus_timeouts_total", "Requests not answered within the timeout", ("slave",))
+        self.modbus_frame_errors = Counter("modbus_frame_errors_total", "Timeouts with a corrupted or incomplete frame received, bad CRC mostly", ("slave",))
+        self.modbus_failures = Counter("modbus_failures_total", "Transactions failed after all retries", ("slave",))
+        self.cycle_duration = Histogram("monitor_cycle_seconds", "Monitoring cycle of all invertors", CYCLE_BUCKETS)
+        self.outbox_pending = Gauge("outbox_pending_messages", "Messages in the outbox waiting for the cloud")
+        self.outbox_sent = Counter("outbox_sent_total", "Messages sent from the outbox to the cloud")
+        self.outbox_drain_rate = Gauge("outbox_drain_messages_per_second", "Send rate of the last outbox drain")
+        self.register_metrics()
+
+    def register_metrics(self):
+        self.metrics.register(
+            self.modbus_latency, self.modbus_timeouts, self.modbus_frame_errors, self.modbus_failures,
+            *self.bus.wait_time.values(), self.bus.deadline_misses,
+            Gauge("serial_baudrate", "Current serial line speed", func=lambda: self.baudrate),
+            self.cycle_duration, self.regulation_latency,
+            self.outbox_pending, self.outbox_sent, self.outbox_drain_rate,
+            self.loop_monitor.lag, self.loop_monitor.stall_count,
+        )
+        if self.cloud_sender:
+            self.metrics.register(self.cloud_sender.latency, self.cloud_sender.failures, self.cloud_sender.body_bytes,
+                                  self.cloud_sender.compression_ratio, self.cloud_sender.compression_cpu)
+        if self.rtu_monitor:
+            self.metrics.register(self.rtu_monitor.read_latency)
+        if self.influx_writer:
+            self.metrics.register(self.influx_writer.latency, self.influx_writer.failures)
+        if self.event_sender:
+            self.metrics.register(self.event_sender.suppressed)
 
     def invertors_from_cfg(self) -> List[Invertor]:
         invertors = []
         invertor_no = 1
+        # Either one nominal power for all invertors or dict by slave address
+        nominal_power = getattr(self.config, "invertor_nominal_power", HT_NOMINAL_POWER)
         for slave in self.config.modbus_slaves:
-            invertors.append(Invertor(invertor_no, slave))
+            if isinstance(nominal_power, dict):
+                invertors.append(Invertor(invertor_no, slave, nominal_power.get(slave, HT_NOMINAL_POWER)))
+            else:
+                invertors.append(Invertor(invertor_no, slave, nominal_power))
             invertor_no += 1
         return invertors
 
@@ -53,122 +155,371 @@ class GoodweHTSet:
         await asyncio.sleep(2)
         log.info("Started socat")
 
-    async def run(self):
-
-        await self.event_sender.send_event(f"Started Invertor Monitor {self.config.plant}")
-
-        self.client = AsyncModbusSerialClient(
+    def create_client(self) -> AsyncModbusSerialClient:
+        return AsyncModbusSerialClient(
             port=self.config.serial_device,
-            baudrate=9600,
+            baudrate=self.baudrate,
             bytesize=8,
             parity="N",
             stopbits=1,
+            timeout=CLIENT_TIMEOUT_SEC,
+            retries=0,
+            broadcast_enable=True,
+            on_reconnect_callback=self.on_bus_connected,
         )
 
+    async def run(self):
+
+        await self.event_sender.send_event(f"Started Invertor Monitor {self.config.plant}")
+
+        self.client = self.create_client()
+
         if self.config.serial_device == "/tmp/ttyVirtual":
             await self.start_socat()
 
+        log.info(f"Opening {self.config.serial_device} at {self.baudrate} baud")
         await self.client.connect()
 
         await self.db.connect()
 
+        metrics_port = getattr(self.config, "metrics_port", None)
+        if metrics_port:
+            self.metrics_server = MetricsServer(self.metrics, metrics_port, getattr(self.config, "metrics_host", METRICS_HOST))
+            # Recent stalls with stacks, also logged on SIGUSR1
+            self.metrics_server.add_page("/stalls", self.loop_monitor.dump)
+            await self.metrics_server.start()
+        self.loop_monitor.start(getattr(self.config, "loop_debug", False))
+
+        self.rtu_monitor.change_listeners.append(lambda inputs, regulation: self.regulation_wakeup.set())
+        self.rtu_monitor.start()
+        self.regulation_task = asyncio.create_task(self.regulation_loop())
+
         while True:
-            log.info(f"=== Cycle === {datetime.datetime.now()}")
+            await self.monitor_cycle()
+            log.info(f"Waiting {ROUND_SEC} seconds before next cycle...")
+            await asyncio.sleep(ROUND_SEC)
 
-            # Read regulation setup from RTU
-            power_adjust = None
+    async def monitor_cycle(self):
+        """One monitoring round: read all invertors, store and upload the data"""
+        log.info(f"=== Cycle === {datetime.datetime.now()}")
+        self.profiler.start_cycle()
+
+        # Standard invertor monitoring
+        try:
+            for invertor in self.invertors:
+                await self.monitor_invertor(invertor)
+            with self.profiler.span("cloud_drain"):
+                await self.drain_outbox()
+        except Exception as e:
+            log.error(f"Error in reading cycle: {e}")
+            await self.event_sender.send_event(f"Error in reading cycle: {e}")
+
+        record = self.profiler.end_cycle()
+        self.cycle_duration.observe(record["duration"])
+        log.info(f"Cycle took {record['duration']:.3f} sec, {self.profiler.summary(['cycle', 'modbus_read', 'json', 'db_insert', 'influx_write', 'cloud_drain'])}")
+        await self.profiler.store(record)
+
+        if self.capture:
+            self.capture.flush()
+        log.info(f"Bus wait times: {self.bus.summary()}")
+        for slave, estimator in self.rtt.items():
+            log.info(f"Slave {slave} response time: {estimator}")
+        await self.check_bus_errors()
+
+    async def monitor_invertor(self, invertor: Invertor):
+        log.info(f"Invertor round: {invertor}")
+        try:
+            regs = await self.read_invertor_regs(invertor)
+            await self.process_invertor_regs(invertor, regs)
+        except Exception as e:
+            log.error(f"Failed to process invertor monitoring {invertor}: {e}")
+            invertor.invalidate_power_adjust()
+            invertor.invalidate_active_power()
+            await self.event_sender.send_event(f"Failed to process invertor monitoring {invertor}: {e}", source=str(invertor))
+
+    async def drain_outbox(self, max_count: int = OUTBOX_DRAIN_MAX) -> int:
+        """Send pending messages from db to the cloud, newest first, returns count sent"""
+        started = time.monotonic()
+        count = 0
+        while True:
             try:
-                # Read percent regulation from RTU signals (0%, 30%, 60%, 100%)
-                regulation = await self.rtu_monitor.read_requested_regulation()
-                power_adjust = int(regulation * HT_NOMINAL_POWER / 100)
-                log.info(f"Power adjust: {power_adjust} from regulation {regulation}")
-
-                for invertor in self.invertors:
-                    try:
-                        actual_power_adjust = await self.get_actual_power_adjust(invertor)
-                        if actual_power_adjust != power_adjust:
-                            log.info(f"Need update power adjust {actual_power_adjust} in invertor {invertor}, RTU request: {power_adjust}")
-                            await self.set_actual_power_adjust(invertor, power_adjust)
-                            await self.event_sender.send_event(f"Updated Power Adjust {self.config.plant} to {power_adjust}")
+                msg:Msg = await self.db.pending_msg_get()
+                if not msg:
+                    log.info("No other messages")
+                    break
+                try:
+                    keyframe_request = await self.cloud_sender.send(msg.msg)
+                    await self.db.update_done(msg)
+                    if keyframe_request and self.delta_encoder:
+                        # Newest first drain sends deltas before their keyframe, it may still wait in the outbox
+                        if await self.db.pending_count() == 0:
+                            self.delta_encoder.request_keyframe(keyframe_request)
                         else:
-                            log.info(f"Skip power adjust {actual_power_adjust} in invertor {invertor}, actual is the same.")
-                    except Exception as e:
-                        log.error(f"Error in reading/setting regulation for {invertor}: {e}")
-                        await self.event_sender.send_event(f"Error in reading/setting regulation for {self.config.plant} {invertor}", f"{e}")
+                            log.debug(f"Keyframe request of slave {keyframe_request} ignored, outbox not drained yet")
+                except Exception as e:
+                    log.error(f"Failed to write to Cloud: {e}, skipping next")
+                    break
+                count += 1
+                self.outbox_sent.inc()
+
+                if count == max_count:
+                    log.info(f"Skipping next pending message after {count}, will be processed next round")
+                    break
+
+            except Exception as e:
+                log.error(f"Exception getting msg from db and sending to cloud: {e}")
+                break
+        if count:
+            self.outbox_drain_rate.set(count / (time.monotonic() - started))
+        try:
+            self.outbox_pending.set(await self.db.pending_count())
+        except Exception as e:
+            log.error(f"Could not count pending messages: {e}")
+        return count
+
+    async def process_invertor_regs(self, invertor: Invertor, regs: GoodweHTRegs, timestamp: datetime.datetime = None):
+        """Registers read in the cycle go to the outbox and Influx, shared with capture replay"""
+        invertor.set_active_power(regs.get_value(RegName.ACTIVE_POWER))
+        self.print_invertor_regs(regs)
+
+        # convert regs to json
+        with self.profiler.span("json"):
+            json_str = self.generate_invetor_regs_json(regs, invertor, self.config, timestamp)
+        json_log.info(json_str)
+
+        with self.profiler.span("db_insert"):
+            await self.db.insert_message("data", json_str)
+        self.outbox_pending.inc()
+
+        try:
+            with self.profiler.span("influx_write"):
+                self.write_influx_invertor_regs(regs, invertor, timestamp)
+            log.info("Data successfully written to InfluxDB")
+        except Exception as e:
+            log.error(f"Failed to write to InfluxDB: {e}")
+            await self.event_sender.send_event(f"Failed to write to InfluxDB: {e}", source=str(invertor))
+
+    async def regulation_loop(self):
+        """Poll RTU regulation inputs and push power adjust to invertors as soon as it changes"""
+        poll_sec = getattr(self.config, "regulation_poll_sec", REGULATION_POLL_SEC)
+        last_regulation = None
+        while True:
+            started = time.monotonic()
+            self.regulation_wakeup.clear()
+            try:
+                # Read percent regulation from RTU signals (0%, 30%, 60%, 100%)
+                with self.profiler.span("rtu_read"):
+                    regulation = await self.rtu_monitor.read_requested_regulation()
+                changed = regulation != last_regulation
+                if self.plant_controller:
+                    setpoints = self.plant_controller.plan(regulation, self.invertors, changed)
+                else:
+                    setpoints = {invertor.slave_address: int(regulation * invertor.nominal_power / 100) for invertor in self.invertors}
+                if changed:
+                    log.info(f"Power adjust: {setpoints} from regulation {regulation}, previous regulation {last_regulation}")
+                    last_regulation = regulation
+
+                # Re-planned setpoints of the plant controller are not worth a mail
+                notify = changed or not self.plant_controller
+                with self.profiler.span("apply_setpoints"):
+                    applied = await self.apply_setpoints(setpoints, force_retry=changed, notify=notify)
+                if applied and changed:
+                    latency = time.monotonic() - started
+                    self.regulation_latency.observe(latency)
+                    log.info(f"Regulation {regulation} applied to all invertors in {latency:.3f} sec, {self.regulation_latency.summary()}")
             except Exception as e:
                 # TODO - toto nechceme, chceme nastavit 100% i kdyz nejede
                 log.error(f"Exception getting/setting RTU regulation: {e}, skipping power regulation...")
                 await self.event_sender.send_event(f"Error in reading/setting regulation for {self.config.plant}", f"{e}")
-
-            # Standard invertor monitoring
             try:
-                for invertor in self.invertors:
-                    log.info(f"Invertor round: {invertor}")
-                    try:
-                        regs = await self.read_invertor_regs(invertor)
-                        self.print_invertor_regs(regs)
-
-                        # convert regs to json
-                        json_str = self.generate_invetor_regs_json(regs, invertor, self.config)
-                        print(json_str)
-
-                        await self.db.insert_message("data", json_str)
-
-                        try:
-                            self.write_influx_invertor_regs(regs, invertor)
-                            log.info("Data successfully written to InfluxDB")
-                        except Exception as e:
-                            log.error(f"Failed to write to InfluxDB: {e}")
-                            await self.event_sender.send_event(f"Failed to write to InfluxDB: {e}")
-                    except Exception as e:
-                        log.error(f"Failed to process invertor monitoring {invertor}: {e}")
-                        await self.event_sender.send_event(f"Failed to process invertor monitoring {invertor}: {e}")
-
-                # Read pending messages from db and send them, max 50 at a time
-                count = 0
-                while True:
-                    try:
-                        msg:Msg = await self.db.pending_msg_get()
-                        if not msg:
-                            log.info("No other messages")
-                            break
-                        count += 1
-                        try:
-                            await self.cloud_sender.send(msg.msg)
-                            await self.db.update_done(msg)
-                        except Exception as e:
-                            log.error(f"Failed to write to Cloud: {e}, skipping next")
-                            break
-
-                        if count == 200:
-                            log.info(f"Skipping next pending message after {count}, will be processed next round")
-                            break
-
-                    except Exception as e:
-                        log.error(f"Exception getting msg from db and sending to cloud: {e}")
-                        break
-
-
+                await asyncio.wait_for(self.regulation_wakeup.wait(), max(0.0, poll_sec - (time.monotonic() - started)))
+            except asyncio.TimeoutError:
+                pass
+
+    async def apply_setpoints(self, setpoints: dict, force_retry: bool = False, notify: bool = True) -> bool:
+        """Update invertors whose power adjust differs from setpoints by slave address, returns True when all are set
+
+        Reads go as REGULATION and writes as CONTROL bus transactions, their wait times are kept apart.
+        """
+        now = time.monotonic()
+        pending = [invertor for invertor in self.invertors
+                   if invertor.power_adjust != setpoints[invertor.slave_address] and (force_retry or now >= invertor.power_adjust_retry_at)]
+        if not pending:
+            return all(invertor.power_adjust == setpoints[invertor.slave_address] for invertor in self.invertors)
+
+        # Broadcast reaches every slave on the bus, not only the pending ones, so all setpoints must agree;
+        # all invertors are read back, any of them may have taken the value
+        values = set(setpoints[invertor.slave_address] for invertor in self.invertors)
+        if getattr(self.config, "power_adjust_broadcast", False) and len(pending) > 1 and len(values) == 1:
+            pending = await self.broadcast_power_adjust(self.invertors, values.pop())
+        for invertor in pending:
+            power_adjust = setpoints[invertor.slave_address]
+            try:
+                with self.profiler.span("power_adjust_check"):
+                    actual_power_adjust = await self.get_actual_power_adjust(invertor)
+                if actual_power_adjust != power_adjust:
+                    log.info(f"Need update power adjust {actual_power_adjust} in invertor {invertor}, RTU request: {power_adjust}")
+                    await self.set_actual_power_adjust(invertor, power_adjust)
+                    if notify:
+                        await self.event_sender.send_event(f"Updated Power Adjust {self.config.plant} to {power_adjust}", coalesce=False)
+                else:
+                    log.info(f"Skip power adjust {actual_power_adjust} in invertor {invertor}, actual is the same.")
             except Exception as e:
-                log.error(f"Error in reading cycle: {e}")
-                await self.event_sender.send_event(f"Error in reading cycle: {e}")
-                
-            log.info(f"Waiting {ROUND_SEC} seconds before next cycle...")
-            await asyncio.sleep(ROUND_SEC)
+                log.error(f"Error in reading/setting regulation for {invertor}: {e}")
+                invertor.power_adjust = None
+                invertor.invalidate_power_adjust()
+                invertor.power_adjust_retry_at = time.monotonic() + REGULATION_RETRY_SEC
+                await self.event_sender.send_event(f"Error in reading/setting regulation for {self.config.plant} {invertor}", f"{e}", source=str(invertor))
+        return all(invertor.power_adjust == setpoints[invertor.slave_address] for invertor in self.invertors)
+
+    async def broadcast_power_adjust(self, invertors: List[Invertor], power_adjust: int) -> List[Invertor]:
+        """Write power adjust to all slaves in one broadcast frame and verify it by read back
+
+        Returns invertors which did not take the broadcast value and need a unicast write.
+        """
+        started = time.monotonic()
+        await self.write_power_adjust_register(BROADCAST_SLAVE, power_adjust)
+        log.info(f"Broadcast power adjust {power_adjust} sent")
+
+        failed = []
+        for invertor in invertors:
+            try:
+                invertor.set_power_adjust(await self.read_invertor_power_adjust(invertor))
+            except Exception as e:
+                log.error(f"Error verifying broadcast power adjust for {invertor}: {e}")
+                invertor.power_adjust = None
+                invertor.invalidate_power_adjust()
+            if invertor.power_adjust != power_adjust:
+                failed.append(invertor)
+        log.info(f"Broadcast power adjust {power_adjust} verified in {time.monotonic() - started:.3f} sec, {len(invertors) - len(failed)} of {len(invertors)} invertors OK")
+        if len(failed) < len(invertors):
+            await self.event_sender.send_event(f"Updated Power Adjust {self.config.plant} to {power_adjust}", coalesce=False)
+        return failed
+
+    async def check_bus_errors(self):
+        """Renegotiate serial speed when too many transactions of the last cycle failed
+
+        Only slaves which answered at least once count, an invertor switched off at night
+        fails all its transactions and says nothing about the line quality.
+        """
+        cycle_errors = self.cycle_errors
+        self.cycle_errors = {}
+        if not getattr(self.config, "serial_baudrate_auto", False):
+            return
+        answering = {slave: counts for slave, counts in cycle_errors.items() if counts[1] < counts[0]}
+        requests = sum(counts[0] for counts in answering.values())
+        failures = sum(counts[1] for counts in answering.values())
+        if requests < BAUD_FALLBACK_MIN_REQUESTS or failures / requests <= BAUD_FALLBACK_ERROR_RATE:
+            return
+        if self.baud_negotiated_at is not None and time.monotonic() - self.baud_negotiated_at < BAUD_NEGOTIATION_INTERVAL_SEC:
+            return
+        self.baud_negotiated_at = time.monotonic()
+        log.warning(f"{failures} of {requests} bus transactions failed at {self.baudrate} baud, renegotiating serial speed")
+
+        try:
+            baudrate = await BaudNegotiator(self.config.serial_device, sorted(answering)).negotiate(slot=self.baud_attempt_slot)
+        except BusDeadlineExceeded as e:
+            log.warning(f"Serial speed negotiation postponed: {e}")
+            return
+        except Exception as e:
+            log.error(f"Serial speed negotiation failed: {e}")
+            return
+        if baudrate and baudrate != self.baudrate:
+            log.warning(f"Serial speed changed from {self.baudrate} to {baudrate}")
+            await self.event_sender.send_event(f"Serial speed {self.config.plant} changed from {self.baudrate} to {baudrate}", coalesce=False)
+            async with self.bus.hold(BusPriority.DIAGNOSTICS):
+                self.baudrate = baudrate
+                self.rtt = {invertor.slave_address: RttEstimator() for invertor in self.invertors}
+                self.client.close()
+                self.client = self.create_client()
+                await self.client.connect()
+
+    @contextlib.asynccontextmanager
+    async def baud_attempt_slot(self):
+        """Bus held for one speed attempt of the negotiation, the client is usable again between attempts
+
+        The arbiter does not preempt, a setpoint write waits one attempt at most, not the whole negotiation.
+        """
+        async with self.bus.hold(BusPriority.DIAGNOSTICS):
+            self.client.close()
+            try:
+                yield
+            finally:
+                self.client = self.create_client()
+                await self.client.connect()
+
+    async def bus_read(self, address: int, count: int, slave: int, priority: BusPriority = BusPriority.MONITORING):
+        return await self.bus.execute(priority, self.read_registers, address, count, slave)
+
+    async def read_registers(self, address: int, count: int, slave: int):
+        """Read holding registers, caller must hold the bus"""
+        result = await self.transaction(slave, frame_time(self.baudrate, read_frame_chars(count)),
+                                        self.client.read_holding_registers, address, count)
+        if not result.isError() and len(result.registers) != count:
+            raise Exception(f"Slave {slave} returned {len(result.registers)} registers instead of {count}")
+        return result
+
+    async def transaction(self, slave: int, wire_time: float, func, *args):
+        """Run one Modbus request func(*args, slave=slave) with timeout from slave RTT estimate and block retry budget"""
+        estimator = self.rtt.setdefault(slave, RttEstimator())
+        # Slave which did not answer last time gets single try, so missing invertor fails fast
+        retries = 0 if estimator.missing else BLOCK_RETRIES
+        counts = self.cycle_errors.setdefault(slave, [0, 0])
+        counts[0] += 1
+        for attempt in range(retries + 1):
+            timeout = wire_time + estimator.rto
+            started = time.monotonic()
+            try:
+                result = await asyncio.wait_for(func(*args, slave=slave), timeout)
+            except asyncio.TimeoutError:
+                estimator.on_timeout()
+                self.modbus_timeouts.labels(slave).inc()
+                # pymodbus drops a frame failing the CRC check silently, only bytes left in the framer show it came
+                if getattr(self.client.framer, "_buffer", None):
+                    self.modbus_frame_errors.labels(slave).inc()
+                    self.client.framer.resetFrame()
+                log.warning(f"Slave {slave} no response in {timeout * 1000:.0f} ms, attempt {attempt + 1} of {retries + 1}")
+                continue
+            if attempt == 0:
+                estimator.observe(time.monotonic() - started - wire_time)
+            else:
+                estimator.answered()
+            # RTU has no transaction id, late answer to a previous request must not be taken
+            if result.slave_id != slave:
+                raise Exception(f"Response from slave {result.slave_id} to request for slave {slave}")
+            return result
+        estimator.end_block()
+        counts[1] += 1
+        self.modbus_failures.labels(slave).inc()
+        raise Exception(f"No response from slave {slave} after {retries + 1} attempts")
 
     def addr_diff(self, start_name, end_name):
         dif = self.regs.get(end_name).address - self.regs.get(start_name).address
         #log.info(f"address diff {dif}")
         return self.regs.get(end_name).address - self.regs.get(start_name).address + self.regs.get(end_name).get_size()
 
+    def on_bus_connected(self):
+        # Invertors may have been restarted while the bus was down
+        log.info("Modbus connected, power adjust of all invertors will be revalidated")
+        for invertor in self.invertors:
+            invertor.invalidate_power_adjust()
+
     async def get_actual_power_adjust(self, invertor: Invertor):
-        if not invertor.power_adjust:
-            invertor.power_adjust = await self.read_invertor_power_adjust(invertor)
+        if invertor.power_adjust is None:
+            invertor.set_power_adjust(await self.read_invertor_power_adjust(invertor))
         return invertor.power_adjust
 
+    def revalidate_power_adjust(self, invertor: Invertor, regs: GoodweHTRegs):
+        power_adjust = regs.get_value(RegName.POWER_ADJUST)
+        if invertor.power_adjust is not None and power_adjust != invertor.power_adjust:
+            log.warning(f"Power adjust in {invertor} changed on device from {invertor.power_adjust} to {power_adjust}")
+        else:
+            log.info(f"Power adjust {power_adjust} in {invertor} revalidated")
+        invertor.set_power_adjust(power_adjust)
+
     async def read_invertor_power_adjust(self, invertor: Invertor):
         slave = invertor.slave_address
-        result_adjust = await self.client.read_holding_registers(41480, 1, slave=slave)
+        result_adjust = await self.bus.execute(BusPriority.REGULATION, self.read_registers, 41480, 1, slave)
         decoder = BinaryPayloadDecoder.fromRegisters(result_adjust.registers, byteorder=Endian.BIG, wordorder=Endian.BIG)
         power_adjust = decoder.decode_16bit_uint()
         log.info(f"Read Actual Power adjust for {slave} is {power_adjust}")
@@ -176,38 +527,68 @@ class GoodweHTSet:
 
     async def set_actual_power_adjust(self, invertor: Invertor, power_adjust: int):
         await self.write_invertor_power_adjust(invertor, power_adjust)
-        invertor.power_adjust = power_adjust
+        invertor.set_power_adjust(power_adjust)
 
     async def write_invertor_power_adjust(self, invertor: Invertor, power_adjust: int):
         log.info(f"Writing invertor power adjust: {power_adjust} to {invertor}")
-        slave = invertor.slave_address
+        await self.write_power_adjust_register(invertor.slave_address, power_adjust)
+
+    async def write_power_adjust_register(self, slave: int, power_adjust: int):
         builder = BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.BIG)
         builder.add_16bit_uint(power_adjust)
         registers = builder.to_registers()
         # COMMENT TO DISABLE SETTING OUTPUT POWER:q1
 
-        await self.client.write_registers(41480, registers, slave=slave)
+        async with self.bus.hold(BusPriority.CONTROL):
+            if slave == BROADCAST_SLAVE:
+                # No response to broadcast, the bus stays quiet while slaves process it
+                await self.client.write_registers(41480, registers, slave=slave)
+                await asyncio.sleep(BROADCAST_TURNAROUND_SEC)
+            else:
+                await self.transaction(slave, frame_time(self.baudrate, write_frame_chars(len(registers))),
+                                       self.client.write_registers, 41480, registers)
 
 
     async def read_invertor_regs(self, invertor: Invertor) -> GoodweHTRegs:
         regs = GoodweHTRegs()
-        slave = invertor.slave_address
-        result0 = await self.client.read_holding_registers(32002, 1, slave=slave)
-        result1 = await self.client.read_holding_registers(32016, self.addr_diff(RegName.PV1_U, RegName.INTERNAL_TEMPERATURE), slave=slave)
-        result2 = await self.client.read_holding_registers(32106, self.addr_diff(RegName.CUMULATIVE_POWER_GENERATION, RegName.POWER_GENERATION_YEAR), slave=slave)
-        result3 = await self.client.read_holding_registers(35502, regs.get(RegName.SERIAL_NUMBER).multiplier, slave=slave)
-        result_rtc = await self.client.read_holding_registers(41313, self.addr_diff(RegName.RTC_YEAR_MONTH, RegName.RTC_MINUTE_SECOND), slave=slave)
-
-        regs.decode(result0.registers, regs.get(RegName.OPER_STATUS).address, regs.get(RegName.OPER_STATUS).address)
-        regs.decode(result1.registers, regs.get(RegName.PV1_U).address, regs.get(RegName.INTERNAL_TEMPERATURE).address)
-        regs.decode(result2.registers, regs.get(RegName.CUMULATIVE_POWER_GENERATION).address, regs.get(RegName.POWER_GENERATION_YEAR).address)
-        regs.decode(result3.registers, regs.get(RegName.SERIAL_NUMBER).address, regs.get(RegName.SERIAL_NUMBER).address)
-        regs.decode(result_rtc.registers, regs.get(RegName.RTC_YEAR_MONTH).address, regs.get(RegName.RTC_MINUTE_SECOND).address)
+        for start_name, end_name in READ_BLOCKS:
+            await self.read_block(invertor, regs, start_name, end_name)
+
+        # Operation status change (restart, standby) may reset power adjust in the invertor
+        oper_status = regs.get_value(RegName.OPER_STATUS)
+        if invertor.oper_status is not None and oper_status != invertor.oper_status:
+            log.info(f"Operation status of {invertor} changed from {invertor.oper_status} to {oper_status}")
+            invertor.invalidate_power_adjust()
+        invertor.oper_status = oper_status
+
+        # Cached power adjust is revalidated as part of the monitoring reads, not by the regulation loop
+        if invertor.power_adjust_expired(getattr(self.config, "power_adjust_ttl_sec", POWER_ADJUST_TTL_SEC)):
+            with self.profiler.span("power_adjust_check"):
+                await self.read_block(invertor, regs, RegName.POWER_ADJUST, RegName.POWER_ADJUST)
+                self.revalidate_power_adjust(invertor, regs)
         return regs
 
+    async def read_block(self, invertor: Invertor, regs: GoodweHTRegs, start_name: RegName, end_name: RegName):
+        start_address = regs.get(start_name).address
+        # Every block is a span of its own, aggregated also as modbus_read
+        started = time.monotonic()
+        try:
+            result = await self.bus_read(start_address, self.addr_diff(start_name, end_name), slave=invertor.slave_address)
+        finally:
+            ended = time.monotonic()
+            self.profiler.add("modbus_read", started, ended)
+            self.profiler.add(f"read_{start_name.name}", started, ended)
+            self.modbus_latency.labels(invertor.slave_address, start_name.name).observe(ended - started)
+        if result.isError():
+            raise Exception(f"Error reading {start_name.name}-{end_name.name} from {invertor}: {result}")
+        if self.capture:
+            self.capture.append(invertor.slave_address, start_address, result.registers, time.time())
+        with self.profiler.span("decode"):
+            regs.decode(result.registers, start_address, regs.get(end_name).address)
+
     def print_invertor_regs(self, regs: GoodweHTRegs):
         status = regs.get_value(RegName.OPER_STATUS)
-        log.info(f"Invertor status: {status}")
+        regs_log.info(f"Invertor status: {status}")
 
         # for i in range(1, 25):
         #     pv_u_name = getattr(RegName, f"PV{i}_U")
@@ -216,58 +597,58 @@ class GoodweHTSet:
         #     pv_u = regs.get_value(pv_u_name)
         #     pv_c = regs.get_value(pv_c_name)
         #
-        #     log.info(f"PV{i}: {pv_u:0.1f}V {pv_c:0.2f}A")
+        #     regs_log.info(f"PV{i}: {pv_u:0.1f}V {pv_c:0.2f}A")
 
 
         input_power = regs.get_value(RegName.INPUT_POWER)
-        log.info(f"Input Power: {input_power:0.2f} kW")
+        regs_log.info(f"Input Power: {input_power:0.2f} kW")
 
         grid_ab_voltage = regs.get_value(RegName.GRID_AB_VOLTAGE)
         grid_bc_voltage = regs.get_value(RegName.GRID_BC_VOLTAGE)
         grid_ca_voltage = regs.get_value(RegName.GRID_CA_VOLTAGE)
-        log.info(f"Grid Line Voltages - AB: {grid_ab_voltage:0.1f}V, BC: {grid_bc_voltage:0.1f}V, CA: {grid_ca_voltage:0.1f}V")
+        regs_log.info(f"Grid Line Voltages - AB: {grid_ab_voltage:0.1f}V, BC: {grid_bc_voltage:0.1f}V, CA: {grid_ca_voltage:0.1f}V")
 
         grid_a_voltage = regs.get_value(RegName.GRID_A_VOLTAGE)
         grid_b_voltage = regs.get_value(RegName.GRID_B_VOLTAGE)
         grid_c_voltage = regs.get_value(RegName.GRID_C_VOLTAGE)
-        log.info(f"Grid Phase Voltages - A: {grid_a_voltage:0.1f}V, B: {grid_b_voltage:0.1f}V, C: {grid_c_voltage:0.1f}V")
+        regs_log.info(f"Grid Phase Voltages - A: {grid_a_voltage:0.1f}V, B: {grid_b_voltage:0.1f}V, C: {grid_c_voltage:0.1f}V")
 
         grid_a_current = regs.get_value(RegName.GRID_A_CURRENT)
         grid_b_current = regs.get_value(RegName.GRID_B_CURRENT)
         grid_c_current = regs.get_value(RegName.GRID_C_CURRENT)
-        log.info(f"Grid Currents - A: {grid_a_current:0.3f}A, B: {grid_b_current:0.3f}A, C: {grid_c_current:0.3f}A")
+        regs_log.info(f"Grid Currents - A: {grid_a_current:0.3f}A, B: {grid_b_current:0.3f}A, C: {grid_c_current:0.3f}A")
 
         peak_active_power_day = regs.get_value(RegName.PEAK_ACTIVE_POWER_DAY)
         active_power = regs.get_value(RegName.ACTIVE_POWER)
         reactive_power = regs.get_value(RegName.REACTIVE_POWER)
         power_factor = regs.get_value(RegName.POWER_FACTOR)
-        log.info(f"Peak Active Power (Day): {peak_active_power_day:0.2f} kW")
-        log.info(f"Active Power: {active_power:0.2f} kW")
-        log.info(f"Reactive Power: {reactive_power:0.2f} kvar")
-        log.info(f"Power Factor: {power_factor:0.3f}")
+        regs_log.info(f"Peak Active Power (Day): {peak_active_power_day:0.2f} kW")
+        regs_log.info(f"Active Power: {active_power:0.2f} kW")
+        regs_log.info(f"Reactive Power: {reactive_power:0.2f} kvar")
+        regs_log.info(f"Power Factor: {power_factor:0.3f}")
 
         grid_frequency = regs.get_value(RegName.GRID_FREQUENCY)
         inverter_efficiency = regs.get_value(RegName.INVERTER_EFFICIENCY)
         internal_temperature = regs.get_value(RegName.INTERNAL_TEMPERATURE)
-        log.info(f"Grid Frequency: {grid_frequency:0.2f} Hz")
-        log.info(f"Inverter Efficiency: {inverter_efficiency:0.2f} %")
-        log.info(f"Internal Temperature: {internal_temperature:0.1f} °C")
+        regs_log.info(f"Grid Frequency: {grid_frequency:0.2f} Hz")
+        regs_log.info(f"Inverter Efficiency: {inverter_efficiency:0.2f} %")
+        regs_log.info(f"Internal Temperature: {internal_temperature:0.1f} °C")
 
         cumulative_power_generation = regs.get_value(RegName.CUMULATIVE_POWER_GENERATION)
         power_generation_day = regs.get_value(RegName.POWER_GENERATION_DAY)
         power_generation_month = regs.get_value(RegName.POWER_GENERATION_MONTH)
         power_generation_year = regs.get_value(RegName.POWER_GENERATION_YEAR)
-        log.info(f"Cumulative Power Generation: {cumulative_power_generation:0.2f} kWh")
+        regs_log.info(f"Cumulative Power Generation: {cumulative_power_generation:0.2f} kWh")
         #print(f"Power Generation (Day): {power_generation_day:0.2f} kWh")
         #print(f"Power Generation (Month): {power_generation_month:0.2f} kWh")
         #print(f"Power Generation (Year): {power_generation_year:0.2f} kWh")
 
         active_power_calculation = regs.get_value(RegName.ACTIVE_POWER_CALCULATION)
-        #log.info(f"Active Power Calculation: {active_power_calculation:0.2f} kW")
+        #regs_log.info(f"Active Power Calculation: {active_power_calculation:0.2f} kW")
 
 
         serial_number = regs.get_value(RegName.SERIAL_NUMBER)
-        print(f"Serial Number: {serial_number}")
+        regs_log.info(f"Serial Number: {serial_number}")
 
         rtc_year_month = regs.get_value(RegName.RTC_YEAR_MONTH)
         rtc_day_hour = regs.get_value(RegName.RTC_DAY_HOUR)
@@ -283,58 +664,27 @@ class GoodweHTSet:
         # Convert 2-digit year to 4-digit (assuming 20xx)
         full_year = 2000 + year if year >= 15 else 2000 + year
 
-        log.info(f"Device RTC: {full_year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}")
-        log.info(f"Raw Values - Year/Month: 0x{rtc_year_month:04X}, Day/Hour: 0x{rtc_day_hour:04X}, Minute/Second: 0x{rtc_minute_second:04X}")
+        regs_log.info(f"Device RTC: {full_year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}")
+        regs_log.info(f"Raw Values - Year/Month: 0x{rtc_year_month:04X}, Day/Hour: 0x{rtc_day_hour:04X}, Minute/Second: 0x{rtc_minute_second:04X}")
 
-    def write_influx_invertor_regs(self, regs: GoodweHTRegs, invertor: Invertor):
+    def write_influx_invertor_regs(self, regs: GoodweHTRegs, invertor: Invertor, timestamp: datetime.datetime = None):
         if self.influx_writer:
-            self.influx_writer.write_regs(regs, invertor)
+            self.influx_writer.write_regs(regs, invertor, timestamp)
 
-    def generate_invetor_regs_json(self, regs: GoodweHTRegs, invertor: Invertor, config: Config) -> str:
-        now_utc = datetime.datetime.now(datetime.timezone.utc)
-        iso_string = now_utc.strftime('%Y-%m-%dT%H:%M:%SZ')
-
-        rtc_year_month = regs.get_value(RegName.RTC_YEAR_MONTH)
-        rtc_day_hour = regs.get_value(RegName.RTC_DAY_HOUR)
-        rtc_minute_second = regs.get_value(RegName.RTC_MINUTE_SECOND)
-
-        year = (rtc_year_month >> 8) & 0xFF
-        month = rtc_year_month & 0xFF
-        day = (rtc_day_hour >> 8) & 0xFF
-        hour = rtc_day_hour & 0xFF
-        minute = (rtc_minute_second >> 8) & 0xFF
-        second = rtc_minute_second & 0xFF
-
-        # Convert 2-digit year to 4-digit (assuming 20xx)
-        full_year = 2000 + year if year >= 15 else 2000 + year
-
-        rtc = f"{full_year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}"
-
-        data = {
-            "plant": config.plant,
-            "invertor_no": invertor.invertor_no,
-            "invertor_typ": "goodwe-ht",
-            "slave_address": invertor.slave_address,
-            "power_adjust": invertor.power_adjust,
-            "timestamp": iso_string,
-            "rtc": rtc
-        }
-        
-        for reg in regs.regs.values():
-            if reg.json_name not in regs.skip_names:
-                if reg.typ != RegType.STR:
-                    data[reg.json_name] = round(reg.value, 2)
-                else:
-                    data[reg.json_name] = reg.value
-            
-        return json.dumps(data, indent=2)
+    def generate_invetor_regs_json(self, regs: GoodweHTRegs, invertor: Invertor, config: Config, timestamp: datetime.datetime = None) -> str:
+        now_utc = timestamp or datetime.datetime.now(datetime.timezone.utc)
+        data = self.encoder.build(regs, config.plant, invertor.invertor_no, invertor.slave_address, invertor.power_adjust, now_utc)
+        if self.delta_encoder:
+            data = self.delta_encoder.apply(data)
+        return self.encoder.dumps(data)
 
 
 
 async def main():
-    setup_logging(log_level=logging.INFO)
-
     config = Config()
+    setup_logging(log_level=logging.INFO, json_format=getattr(config, "log_json", False),
+                  max_bytes=getattr(config, "log_max_bytes", LOG_MAX_BYTES), backups=getattr(config, "log_backups", LOG_BACKUPS),
+                  rate_limits=getattr(config, "log_rate_limits", None))
     if config.influx_enable:
         influx_writer = InfluxWriter(
             url=config.influx_url,
@@ -353,9 +703,19 @@ async def main():
         mailer = None
 
     event_sender = EventSender(mailer, config.mail_to_addr)
-    cloud_sender = CloudSender(config.cloud_svc_url)
+    cloud_sender = CloudSender(config.cloud_svc_url, getattr(config, "cloud_wire_format", WIRE_FORMAT_JSON),
+                               getattr(config, "cloud_compression", None), getattr(config, "cloud_compression_level", None),
+                               getattr(config, "cloud_compression_min_bytes", COMPRESSION_MIN_BYTES))
     test = GoodweHTSet(config, influx_writer, rtu_monitor, event_sender, cloud_sender)
-    await test.run()
+    # SIGTERM of docker stop cancels the monitor, queued mails and the event sender state are not lost
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        await test.run()
+    finally:
+        try:
+            await asyncio.wait_for(event_sender.close(), SHUTDOWN_TIMEOUT_SEC)
+        except Exception as e:
+            log.error(f"Could not close event sender: {e}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+import asyncio
+import datetime
+import logging
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from metrics import Counter, Histogram
+
+log = logging.getLogger(__name__)
+
+LAG_INTERVAL_SEC = 0.1
+STALL_THRESHOLD_SEC = 0.2
+STALL_RING_SIZE = 50
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+# Message asyncio debug mode logs for a callback running longer than slow_callback_duration
+SLOW_CALLBACK_MSG = "Executing %s took %.3f seconds"
+
+
+class Stall:
+    def __init__(self, source: str, duration: float, what: str = None, stack: list = None):
+        self.time = datetime.datetime.now()
+        self.source = source  # probe, watchdog or callback
+        self.duration = duration
+        self.what = what
+        self.stack = stack or []
+
+    def __str__(self):
+        lines = [f"{self.time:%Y-%m-%d %H:%M:%S.%f}"[:-3] + f" {self.source} stall {self.duration:.3f} sec" + (f" in {self.what}" if self.what else "")]
+        lines += [line.rstrip("\n") for line in self.stack]
+        return "\n".join(lines)
+
+
+class SlowCallbackHandler(logging.Handler):
+    """Takes slow callback warnings of asyncio debug mode into the stall ring buffer"""
+    def __init__(self, monitor: "LoopMonitor"):
+        super().__init__(logging.WARNING)
+        self.monitor = monitor
+
+    def emit(self, record: logging.LogRecord):
+        if record.msg == SLOW_CALLBACK_MSG and record.args:
+            self.monitor.stalls.append(Stall("callback", record.args[1], str(record.args[0])))
+
+
+class LoopMonitor:
+    """Event loop lag histogram and capture of stalls into a ring buffer
+
+    A probe task measures how late its sleep wakes up. A watchdog thread sees the
+    probe heartbeat getting old while the loop is blocked and takes the stack of
+    the loop thread at that moment, which shows the blocking code. In asyncio debug
+    mode the slow callbacks reported by asyncio are recorded as well.
+    """
+    def __init__(self, interval: float = LAG_INTERVAL_SEC, threshold: float = STALL_THRESHOLD_SEC, ring_size: int = STALL_RING_SIZE):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = Histogram("event_loop_lag_seconds", "Delay of event loop wakeups", LAG_BUCKETS)
+        self.stall_count = Counter("event_loop_stalls_total", f"Event loop blocked longer than {threshold} sec")
+        self.stalls = deque(maxlen=ring_size)
+        self.heartbeat = time.monotonic()
+        self.captured_heartbeat = None  # heartbeat of the stall the watchdog took a stack of
+        self.captured_stall = None
+        self.loop_thread_id = None
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self, debug: bool = False):
+        loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self.probe())
+        self.thread = threading.Thread(target=self.watchdog, name="loop-watchdog", daemon=True)
+        self.thread.start()
+        if debug:
+            # Debug mode slows the loop down, it is meant for hunting a stall reported by the watchdog
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold
+            logging.getLogger("asyncio").addHandler(SlowCallbackHandler(self))
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, self.log_stalls)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass
+
+    def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def probe(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            previous, self.heartbeat = self.heartbeat, now
+            lag = max(0.0, now - started - self.interval)
+            self.lag.observe(lag)
+            if lag > self.threshold:
+                self.stall_count.inc()
+                if self.captured_heartbeat == previous:
+                    # Watchdog took the stack while blocked, now the whole duration is known
+                    self.captured_stall.duration = lag
+                else:
+                    self.stalls.append(Stall("probe", lag))
+
+    def watchdog(self):
+        while not self.stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked <= self.threshold or self.captured_heartbeat == heartbeat:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = traceback.format_stack(frame) if frame else []
+            what = None
+            if frame:
+                what = f"{frame.f_code.co_name} {frame.f_code.co_filename}:{frame.f_lineno}"
+            stall = Stall("watchdog", blocked, what, stack)
+            self.captured_stall = stall
+            self.captured_heartbeat = heartbeat
+            self.stalls.append(stall)
+            log.warning(f"Event loop blocked for {blocked:.3f} sec in {what}")
+
+    def dump(self) -> str:
+        stalls = list(self.stalls)
+        if not stalls:
+            return "No event loop stalls\n"
+        return "\n\n".join(str(stall) for stall in stalls) + "\n"
+
+    def log_stalls(self):
+        log.warning(f"Event loop stalls, last {len(self.stalls)}:\n{self.dump()}")
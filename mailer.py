@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 import aiosmtplib
@@ -7,6 +8,11 @@ import datetime
 
 log = logging.getLogger(__name__)
 
+IDLE_TIMEOUT_SEC = 60
+
+# Errors after which the session is dropped and the message retried on a new connection
+RECONNECT_ERRORS = (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError, aiosmtplib.SMTPTimeoutError, ConnectionError, OSError)
+
 class Mailer:
     def __init__(self, smtp_server, smtp_port, username, password, from_addr):
         self.smtp_server = smtp_server
@@ -14,25 +20,95 @@ class Mailer:
         self.username = username
         self.password = password
         self.from_addr = from_addr
+        self.smtp: aiosmtplib.SMTP = None
+        self.lock = asyncio.Lock()
+        self.idle_task: asyncio.Task = None
 
-    async def send_mail(self, to_addr, subj, message_text):
+    def build_message(self, to_addr, subj, message_text) -> MIMEMultipart:
         message = MIMEMultipart()
         message["From"] = self.from_addr
         message["To"] = to_addr
         message["Subject"] = subj
         message["Date"] = datetime.datetime.now().strftime("%d/%m/%Y %H:%M")
         message.attach(MIMEText(message_text, "plain"))
+        return message
 
-        await aiosmtplib.send(
-            message,
+    async def _connect(self):
+        self.smtp = aiosmtplib.SMTP(
             hostname=self.smtp_server,
             port=self.smtp_port,
             username=self.username,
             password=self.password,
             use_tls=True
         )
-        
-        log.info(f"Sent mail {subj}")
+        await self.smtp.connect()
+        log.info(f"SMTP connected to {self.smtp_server}:{self.smtp_port}")
+
+    async def _disconnect(self):
+        smtp = self.smtp
+        self.smtp = None
+        if not smtp or not smtp.is_connected:
+            return
+        try:
+            await smtp.quit()
+        except Exception as e:
+            log.debug(f"SMTP quit failed: {e}")
+            smtp.close()
+        log.info("SMTP connection closed")
+
+    async def _close_idle(self):
+        await asyncio.sleep(IDLE_TIMEOUT_SEC)
+        async with self.lock:
+            self.idle_task = None
+            try:
+                await self._disconnect()
+            except Exception as e:
+                log.error(f"Closing idle SMTP connection failed: {e}")
 
+    def _cancel_idle_close(self):
+        if self.idle_task:
+            self.idle_task.cancel()
+            self.idle_task = None
+
+    def _schedule_idle_close(self):
+        # Task is referenced until done, the loop keeps only a weak reference
+        self._cancel_idle_close()
+        self.idle_task = asyncio.create_task(self._close_idle())
+
+    async def _send_message(self, message: MIMEMultipart):
+        if not self.smtp or not self.smtp.is_connected:
+            await self._connect()
+        try:
+            await self.smtp.send_message(message)
+        except RECONNECT_ERRORS as e:
+            log.warning(f"SMTP session failed ({e}), reconnecting")
+            await self._disconnect()
+            await self._connect()
+            await self.smtp.send_message(message)
+
+    async def send_mails(self, mails: list) -> int:
+        """Send list of (to_addr, subj, message_text) over one SMTP session, returns number of sent mails"""
+        sent = 0
+        async with self.lock:
+            self._cancel_idle_close()
+            try:
+                for to_addr, subj, message_text in mails:
+                    try:
+                        await self._send_message(self.build_message(to_addr, subj, message_text))
+                        sent += 1
+                        log.info(f"Sent mail {subj}")
+                    except Exception as e:
+                        log.error(f"Failed to send mail {subj}: {e}")
+                        await self._disconnect()
+            finally:
+                self._schedule_idle_close()
+        return sent
+
+    async def send_mail(self, to_addr, subj, message_text):
+        if not await self.send_mails([(to_addr, subj, message_text)]):
+            raise Exception(f"Failed to send mail {subj}")
 
-        
\ No newline at end of file
+    async def close(self):
+        async with self.lock:
+            self._cancel_idle_close()
+            await self._disconnect()
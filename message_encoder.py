@@ -0,0 +1,130 @@
+import datetime
+import json
+import logging
+import time
+
+from registers_goodwe_ht import GoodweHTRegs, RegName, RegType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+INVERTOR_TYP = "goodwe-ht"
+KEYFRAME_INTERVAL = 12 # messages per invertor, an hour of 5 minute cycles
+FRAME_KEY = "key"
+FRAME_DELTA = "delta"
+# Fields added by delta encoding, not part of the full message
+FRAME_FIELDS = ("seq", "frame", "key_seq")
+# Fields every delta carries, rtc changes every cycle anyway
+IDENTITY_FIELDS = ("plant", "invertor_no", "invertor_typ", "slave_address", "timestamp", "rtc")
+# Response header of a receiver missing the keyframe of a delta, value is the slave address
+KEYFRAME_REQUEST_HEADER = "X-Keyframe-Request"
+
+
+class MessageEncoder:
+    """Cloud message JSON of one invertor reading, compiled once per register layout
+
+    Keys and their order are those of the original message, only whitespace is
+    left out. Register values go through a precomputed (key, is string) layout in
+    the order of GoodweHTRegs.regs, skipped registers have no key. orjson is used
+    when installed and fast is set, the output parses to the same object.
+    """
+    def __init__(self, regs: GoodweHTRegs, fast: bool = True):
+        skip_names = set(regs.skip_names)
+        self.layout = tuple((None if reg.json_name in skip_names else reg.json_name, reg.typ == RegType.STR)
+                            for reg in regs.regs.values())
+        if fast and orjson:
+            self.dumps = lambda data: orjson.dumps(data).decode()
+        else:
+            self.dumps = json.JSONEncoder(separators=(",", ":"), check_circular=False).encode
+
+    @staticmethod
+    def rtc(regs: GoodweHTRegs) -> str:
+        year_month = regs.get_value(RegName.RTC_YEAR_MONTH)
+        day_hour = regs.get_value(RegName.RTC_DAY_HOUR)
+        minute_second = regs.get_value(RegName.RTC_MINUTE_SECOND)
+        # 2-digit year of the invertor clock is 20xx
+        return (f"{2000 + ((year_month >> 8) & 0xFF):04d}-{year_month & 0xFF:02d}-{(day_hour >> 8) & 0xFF:02d} "
+                f"{day_hour & 0xFF:02d}:{(minute_second >> 8) & 0xFF:02d}:{minute_second & 0xFF:02d}")
+
+    def encode(self, regs: GoodweHTRegs, plant: str, invertor_no: int, slave_address: int, power_adjust, timestamp: datetime.datetime) -> str:
+        return self.dumps(self.build(regs, plant, invertor_no, slave_address, power_adjust, timestamp))
+
+    def build(self, regs: GoodweHTRegs, plant: str, invertor_no: int, slave_address: int, power_adjust, timestamp: datetime.datetime) -> dict:
+        data = {
+            "plant": plant,
+            "invertor_no": invertor_no,
+            "invertor_typ": INVERTOR_TYP,
+            "slave_address": slave_address,
+            "power_adjust": power_adjust,
+            "timestamp": timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            "rtc": self.rtc(regs),
+        }
+        if len(regs.regs) != len(self.layout):
+            raise Exception(f"Register layout changed, {len(regs.regs)} registers instead of {len(self.layout)}")
+        # Decode replaces NaN and Inf, every value is valid JSON
+        for reg, (key, is_str) in zip(regs.regs.values(), self.layout):
+            if key:
+                data[key] = reg.value if is_str else round(reg.value, 2)
+        return data
+
+
+class DeltaStream:
+    def __init__(self, seq: int):
+        self.seq = seq
+        self.keyframe = None
+        self.key_seq = None
+        self.since_keyframe = 0
+
+
+class DeltaEncoder:
+    """Keyframe with all fields every interval messages of an invertor, deltas in between
+
+    A delta carries the identity fields, timestamp and rtc, and the fields which
+    differ from its keyframe. Deltas refer to the keyframe and not to the previous
+    message, so a lost delta costs only itself and the outbox may send newest first.
+    Receiver missing the keyframe of a delta asks for a new one (request_keyframe).
+    """
+    def __init__(self, interval: int = KEYFRAME_INTERVAL):
+        self.interval = interval
+        self.streams = {}  # slave address -> DeltaStream
+
+    def request_keyframe(self, slave_address):
+        try:
+            stream = self.streams.get(int(slave_address))
+        except ValueError:
+            log.warning(f"Invalid keyframe request {slave_address}")
+            return
+        if stream:
+            log.info(f"Keyframe of slave {slave_address} requested by receiver")
+            stream.keyframe = None
+
+    def apply(self, data: dict) -> dict:
+        stream = self.streams.get(data["slave_address"])
+        if stream is None:
+            # Seeded by the clock, sequence keeps growing over restarts with one message per cycle
+            stream = self.streams[data["slave_address"]] = DeltaStream(int(time.time()))
+        stream.seq += 1
+        if stream.keyframe is None or stream.since_keyframe >= self.interval:
+            stream.keyframe = data
+            stream.key_seq = stream.seq
+            stream.since_keyframe = 1
+            return {**data, "seq": stream.seq, "frame": FRAME_KEY}
+        stream.since_keyframe += 1
+        keyframe = stream.keyframe
+        delta = {key: data[key] for key in IDENTITY_FIELDS}
+        delta.update(seq=stream.seq, frame=FRAME_DELTA, key_seq=stream.key_seq)
+        for key, value in data.items():
+            if key not in delta and keyframe.get(key) != value:
+                delta[key] = value
+        return delta
+
+
+def rebuild(keyframe: dict, delta: dict) -> dict:
+    """Full message of a delta, as it would be without delta encoding"""
+    record = {key: value for key, value in keyframe.items() if key not in FRAME_FIELDS}
+    record.update((key, value) for key, value in delta.items() if key not in FRAME_FIELDS)
+    return record
@@ -0,0 +1,175 @@
+import bisect
+import logging
+import math
+
+log = logging.getLogger(__name__)
+
+# Upper bounds in seconds, tuned for Modbus transactions and control reaction times
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    return str(value)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metric:
+    """Metric family in Prometheus text format
+
+    Metric with label names is only a parent, values live in children created by
+    labels() on first use and kept forever. Series names are built once, so a scrape
+    formats one line per sample and nothing else.
+    """
+    typ = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.children = {}  # tuple of label values -> child metric
+        self.header = f"# HELP {name} {help_text}\n# TYPE {name} {self.typ}\n"
+        self.set_labels("")
+
+    def set_labels(self, labels: str):
+        self.series = f"{self.name}{{{labels}}}" if labels else self.name
+
+    def child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} has labels {self.labelnames}, got {values}")
+            child = self.child()
+            child.set_labels(",".join(f'{name}="{escape_label(value)}"' for name, value in zip(self.labelnames, values)))
+            self.children[values] = child
+        return child
+
+    def samples(self, out: list):
+        raise NotImplementedError
+
+    def expose(self, out: list):
+        out.append(self.header)
+        if self.labelnames:
+            for child in self.children.values():
+                child.samples(out)
+        else:
+            self.samples(out)
+
+
+class Counter(Metric):
+    """Monotonic count, func() is read at scrape time instead of the own value when given"""
+    typ = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), func=None):
+        super().__init__(name, help_text, labelnames)
+        self.value = 0
+        self.func = func
+
+    def child(self):
+        return Counter(self.name, self.help_text)
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self, out: list):
+        out.append(f"{self.series} {format_value(self.func() if self.func else self.value)}\n")
+
+
+class Gauge(Counter):
+    typ = "gauge"
+
+    def child(self):
+        return Gauge(self.name, self.help_text)
+
+    def set(self, value: float):
+        self.value = value
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+
+class Histogram(Metric):
+    """Fixed bucket histogram, observe() is O(log buckets) and allocation free"""
+    typ = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS, labelnames=()):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def set_labels(self, labels: str):
+        super().set_labels(labels)
+        prefix = labels + "," if labels else ""
+        self.bucket_series = [f'{self.name}_bucket{{{prefix}le="{format_value(bucket)}"}}' for bucket in self.buckets + (math.inf,)]
+        self.sum_series = f"{self.name}_sum{{{labels}}}" if labels else f"{self.name}_sum"
+        self.count_series = f"{self.name}_count{{{labels}}}" if labels else f"{self.name}_count"
+
+    def child(self):
+        return Histogram(self.name, self.help_text, self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Estimate quantile by linear interpolation inside the bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - cumulative) / bucket_count, self.max)
+            cumulative += bucket_count
+        return self.max
+
+    def summary(self) -> str:
+        if not self.count:
+            return f"{self.name}: no data"
+        return f"{self.name}: count {self.count}, avg {self.sum / self.count:.3f}, p50 {self.quantile(0.5):.3f}, p95 {self.quantile(0.95):.3f}, max {self.max:.3f}"
+
+    def samples(self, out: list):
+        cumulative = 0
+        for series, bucket_count in zip(self.bucket_series, self.counts):
+            cumulative += bucket_count
+            out.append(f"{series} {cumulative}\n")
+        out.append(f"{self.sum_series} {format_value(self.sum)}\n")
+        out.append(f"{self.count_series} {self.count}\n")
+
+
+class Registry:
+    """Metrics exposed together, scrape cost depends only on the number of series"""
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, *metrics: Metric):
+        for metric in metrics:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self.metrics[metric.name] = metric
+
+    def expose(self) -> str:
+        out = []
+        for metric in self.metrics.values():
+            try:
+                metric.expose(out)
+            except Exception as e:
+                log.error(f"Could not expose metric {metric.name}: {e}")
+        return "".join(out)
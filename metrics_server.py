@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import time
+
+from metrics import Histogram, Registry
+
+log = logging.getLogger(__name__)
+
+METRICS_PATH = b"/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+REQUEST_TIMEOUT_SEC = 5
+MAX_REQUEST_HEADERS = 100
+SCRAPE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+
+
+class MetricsServer:
+    """Minimal HTTP server answering GET /metrics in Prometheus text format
+
+    Runs on the monitor event loop, a scrape only formats the current values and
+    never waits for the bus or the database. Other plain text pages can be added.
+    """
+    def __init__(self, registry: Registry, port: int, host: str = "0.0.0.0"):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.server = None
+        self.pages = {METRICS_PATH: registry.expose}
+        self.scrape_time = Histogram("metrics_scrape_seconds", "Time to format the metrics page", SCRAPE_BUCKETS)
+        registry.register(self.scrape_time)
+
+    def add_page(self, path: str, func):
+        """Serve text returned by func() on GET path"""
+        self.pages[path.encode()] = func
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        log.info(f"Metrics on http://{self.host}:{self.port}{METRICS_PATH.decode()}")
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT_SEC)
+            # Headers are not needed, only read up to the empty line
+            for _ in range(MAX_REQUEST_HEADERS):
+                line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT_SEC)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request.split()
+            page = self.pages.get(parts[1].split(b"?")[0]) if len(parts) >= 2 and parts[0] == b"GET" else None
+            if page:
+                started = time.monotonic()
+                body = page().encode()
+                if page == self.registry.expose:
+                    self.scrape_time.observe(time.monotonic() - started)
+                status = "200 OK"
+            else:
+                body = b"Not found\n"
+                status = "404 Not Found"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            log.debug(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
+
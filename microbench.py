@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the CPU hot paths of one invertor reading on fixed register fixtures:
+block decode, Reg.decode per type, JSON message and Influx point building
+Reports ns/op and peak memory of one call (tracemalloc, temporaries included)
+Usage: python microbench.py [--filter decode] [--output benchmarks] [--compare benchmarks/old.json]
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+from pymodbus.constants import Endian
+from pymodbus.payload import BinaryPayloadDecoder
+
+from benchmark import compare, version
+from config import Config
+from influx import InfluxWriter
+from invertor import Invertor
+from invertor_monitor_main import GoodweHTSet, READ_BLOCKS
+from message_encoder import MessageEncoder, orjson
+from registers_goodwe_ht import GoodweHTRegs, Reg, RegName, RegType
+from wire_format import PackedRecordCodec, loads
+
+REPEAT = 5
+REGRESSION_THRESHOLD = 0.15
+TIMESTAMP = datetime.datetime(2026, 6, 21, 12, 0, tzinfo=datetime.timezone.utc)
+
+
+def fixture_regs() -> GoodweHTRegs:
+    """Noon reading of a 110 kW invertor with 20 of 24 strings connected"""
+    regs = GoodweHTRegs()
+    for i in range(1, 25):
+        regs.set_value(getattr(RegName, f"PV{i}_U"), 612.3 + i if i <= 20 else 0.0)
+        regs.set_value(getattr(RegName, f"PV{i}_C"), 9.12 if i <= 20 else 0.0)
+    values = {
+        RegName.OPER_STATUS: 1, RegName.INPUT_POWER: 112.345,
+        RegName.GRID_AB_VOLTAGE: 401.2, RegName.GRID_BC_VOLTAGE: 400.8, RegName.GRID_CA_VOLTAGE: 399.9,
+        RegName.GRID_A_VOLTAGE: 231.1, RegName.GRID_B_VOLTAGE: 230.4, RegName.GRID_C_VOLTAGE: 229.8,
+        RegName.GRID_A_CURRENT: 158.123, RegName.GRID_B_CURRENT: 158.456, RegName.GRID_C_CURRENT: 157.789,
+        RegName.PEAK_ACTIVE_POWER_DAY: 109.9, RegName.ACTIVE_POWER: 109.876, RegName.REACTIVE_POWER: -1.234,
+        RegName.POWER_FACTOR: 0.999, RegName.GRID_FREQUENCY: 50.01, RegName.INVERTER_EFFICIENCY: 98.42,
+        RegName.INTERNAL_TEMPERATURE: 43.5, RegName.CUMULATIVE_POWER_GENERATION: 312456.78,
+        RegName.POWER_GENERATION_DAY: 456.78, RegName.POWER_GENERATION_MONTH: 9876.54, RegName.POWER_GENERATION_YEAR: 76543.21,
+        RegName.ACTIVE_POWER_CALCULATION: 110, RegName.SERIAL_NUMBER: "5010KHTU12345678",
+        RegName.RTC_YEAR_MONTH: 26 << 8 | 6, RegName.RTC_DAY_HOUR: 21 << 8 | 12, RegName.RTC_MINUTE_SECOND: 0,
+        RegName.POWER_ADJUST: 80,
+    }
+    for name, value in values.items():
+        regs.set_value(name, value)
+    return regs
+
+
+def fixture_blocks(regs: GoodweHTRegs) -> dict:
+    """Raw words of every block the monitor reads, keyed by block name"""
+    blocks = {}
+    for start_name, end_name in READ_BLOCKS + [(RegName.POWER_ADJUST, RegName.POWER_ADJUST)]:
+        start, end = regs.get(start_name).address, regs.get(end_name).address
+        words = []
+        for reg in regs.regs.values():
+            if start <= reg.address <= end:
+                words += regs.encode(reg.address, reg.address)
+        blocks[start_name.name if start_name == end_name else f"{start_name.name}-{end_name.name}"] = (words, start, end)
+    return blocks
+
+
+class MicroBench:
+    def __init__(self, name_filter: str = None):
+        self.name_filter = name_filter
+        self.results = {}
+
+    def run(self, name: str, func):
+        if self.name_filter and self.name_filter not in name:
+            return
+        timer = timeit.Timer(func)
+        loops, _ = timer.autorange()
+        best = min(timer.repeat(REPEAT, loops)) / loops
+
+        # Peak of memory held while one call runs, temporaries included. tracemalloc sees
+        # live blocks only, allocations freed within the call can not be counted
+        gc.collect()
+        tracemalloc.start()
+        func()
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.results[name] = {"ns_per_op": best * 1e9, "peak_bytes_per_op": peak - base}
+        print(f"{name:56} {best * 1e9:12.0f} ns/op {peak - base:10d} B peak")
+
+
+def reg_fixtures(regs: GoodweHTRegs) -> dict:
+    """One register of every type with its raw words"""
+    fixtures = {}
+    for reg in regs.regs.values():
+        if reg.typ.name not in fixtures:
+            fixtures[reg.typ.name] = (reg, regs.encode(reg.address, reg.address))
+    fixtures["F32"] = (Reg("F32 test", "f32_test", RegType.F32, 0), [0x4248, 0x0000])
+    return fixtures
+
+
+def run_benchmarks(bench: MicroBench):
+    source = fixture_regs()
+    for block, (words, start, end) in fixture_blocks(source).items():
+        regs = GoodweHTRegs()
+        bench.run(f"decode_{block}", lambda: regs.decode(words, start, end))
+
+    for typ, (reg, words) in reg_fixtures(source).items():
+        decoder = BinaryPayloadDecoder.fromRegisters(words, byteorder=Endian.BIG, wordorder=Endian.BIG)
+
+        def decode_reg(reg=reg, decoder=decoder):
+            decoder.reset()
+            reg.decode(decoder)
+        bench.run(f"reg_decode_{typ}", decode_reg)
+
+    config = Config()
+    invertor = Invertor(1, 1, 110)
+    invertor.set_power_adjust(80)
+    monitor = GoodweHTSet(config, None, None, None, None)
+    bench.run("json_message", lambda: monitor.generate_invetor_regs_json(source, invertor, config, TIMESTAMP))
+    if orjson:
+        encoder = MessageEncoder(source, fast=False)
+        bench.run("json_message_stdlib", lambda: encoder.encode(source, config.plant, invertor.invertor_no, invertor.slave_address, invertor.power_adjust, TIMESTAMP))
+
+    codec = PackedRecordCodec(source)
+    message = loads(monitor.generate_invetor_regs_json(source, invertor, config, TIMESTAMP))
+    bench.run("packed_record", lambda: codec.pack(message))
+    record = codec.pack(message)
+    bench.run("packed_record_unpack", lambda: codec.unpack(record))
+
+    bench.run("influx_build_points", lambda: InfluxWriter.build_points(source, invertor, TIMESTAMP))
+    points = InfluxWriter.build_points(source, invertor, TIMESTAMP)
+    bench.run("influx_line_protocol", lambda: [point.to_line_protocol() for point in points])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of decode, JSON and Influx encoding")
+    parser.add_argument("--filter", help="run only benchmarks with this in the name")
+    parser.add_argument("--output", default="benchmarks", help="directory for the result JSON")
+    parser.add_argument("--compare", help="result JSON of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    bench = MicroBench(args.filter)
+    run_benchmarks(bench)
+    results = {
+        "version": version(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "results": bench.results,
+    }
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"microbench_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results stored to {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare} ({baseline.get('version')})")
+        metrics = {f"results.{name}.ns_per_op": False for name in bench.results}
+        if compare(results, baseline, args.threshold, metrics):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
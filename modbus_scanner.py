@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+RS485 commissioning scanner, finds slave addresses, line settings, RTT and block size
+Usage: python modbus_scanner.py [serial_port ...]
+Example: python modbus_scanner.py /dev/ttyAMA2 /dev/ttyUSB0
+Each serial port is a separate bus and is scanned in parallel with the others.
+"""
+
+import asyncio
+import logging
+import sys
+import time
+
+from adaptive_timeout import frame_time
+from modbus_tester import Tester, SERIAL_PORT, SERIAL_BAUDRATE, SERIAL_PARITY, SERIAL_STOPBITS
+
+log = logging.getLogger(__name__)
+
+BAUDRATES = [9600, 19200, 38400, 57600, 115200]
+PARITIES = ["N", "E", "O"]
+SLAVE_IDS = range(1, 248)
+PROBE_ADDRESS = 32002 # Goodwe HT operation status
+BLOCK_TEST_ADDRESS = 32016 # Goodwe HT PV1_U, start of the largest block read by the monitor
+MAX_BLOCK_SIZE = 125
+RTT_SAMPLES = 5
+BLOCK_SAMPLES = 3
+
+SLAVE_TURNAROUND_SEC = 0.05 # typical slave processing time before it answers
+MIN_TIMEOUT_SEC = 0.05
+MAX_TIMEOUT_SEC = 0.5
+CLIENT_TIMEOUT_SEC = 10 # pymodbus own timeout, scanner uses shorter ones by itself
+
+
+class SlaveInfo:
+    def __init__(self, port: str, baudrate: int, parity: str, slave: int):
+        self.port = port
+        self.baudrate = baudrate
+        self.parity = parity
+        self.slave = slave
+        self.rtt = None
+        self.max_block = None
+
+    def __str__(self):
+        rtt = f"{self.rtt * 1000:.0f} ms" if self.rtt is not None else "-"
+        return f"{self.port} {self.baudrate} 8{self.parity}1 slave {self.slave}: RTT {rtt}, max block {self.max_block} registers"
+
+
+class BusScanner:
+    def __init__(self, port: str, probe_address: int = PROBE_ADDRESS, block_address: int = BLOCK_TEST_ADDRESS):
+        self.port = port
+        self.probe_address = probe_address
+        self.block_address = block_address
+
+    def initial_timeout(self, baudrate: int) -> float:
+        # Request (8 chars) + response to 1 register read (7 chars) + slave turnaround, twice as reserve
+        timeout = 2 * (frame_time(baudrate, 15) + SLAVE_TURNAROUND_SEC)
+        return min(MAX_TIMEOUT_SEC, max(MIN_TIMEOUT_SEC, timeout))
+
+    async def read(self, tester: Tester, address: int, count: int, slave: int, timeout: float):
+        """Timed read, returns RTT in seconds or None when slave did not answer correctly"""
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(tester.client.read_holding_registers(address, count, slave=slave), timeout)
+        except Exception as e:
+            log.debug(f"{self.port} slave {slave} no response: {e}")
+            return None
+        if result.isError() or getattr(result, "slave_id", slave) != slave or len(result.registers) != count:
+            return None
+        return time.monotonic() - started
+
+    async def probe(self, tester: Tester, slave: int, timeout: float):
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(tester.client.read_holding_registers(self.probe_address, 1, slave=slave), timeout)
+        except Exception:
+            return None
+        # Modbus exception response is still an answer from a live slave
+        if getattr(result, "slave_id", slave) != slave:
+            return None
+        return time.monotonic() - started
+
+    async def measure(self, tester: Tester, info: SlaveInfo, timeout: float):
+        rtts = []
+        for _ in range(RTT_SAMPLES):
+            rtt = await self.read(tester, self.probe_address, 1, info.slave, timeout)
+            if rtt is not None:
+                rtts.append(rtt)
+        if rtts:
+            info.rtt = sum(rtts) / len(rtts)
+
+        # Binary search for the largest block read reliably, timeout grows with the response length
+        low, high = 0, MAX_BLOCK_SIZE
+        while low < high:
+            count = (low + high + 1) // 2
+            block_timeout = timeout + frame_time(info.baudrate, 2 * count)
+            ok = True
+            for _ in range(BLOCK_SAMPLES):
+                if await self.read(tester, self.block_address, count, info.slave, block_timeout) is None:
+                    ok = False
+                    break
+            if ok:
+                low = count
+            else:
+                high = count - 1
+        info.max_block = low
+
+    async def scan_setting(self, baudrate: int, parity: str, slave_ids=SLAVE_IDS) -> list[SlaveInfo]:
+        tester = Tester({SERIAL_PORT: self.port, SERIAL_BAUDRATE: baudrate, SERIAL_PARITY: parity, SERIAL_STOPBITS: 1})
+        if not await tester.connect(timeout=CLIENT_TIMEOUT_SEC, retries=0, reconnect_delay=0):
+            raise Exception(f"Cannot open {self.port}")
+        found = []
+        try:
+            timeout = self.initial_timeout(baudrate)
+            max_rtt = 0.0
+            for slave in slave_ids:
+                rtt = await self.probe(tester, slave, timeout)
+                if rtt is None:
+                    continue
+                found.append(SlaveInfo(self.port, baudrate, parity, slave))
+                # Once real slaves answered, wait for missing ones only a few times their RTT
+                max_rtt = max(max_rtt, rtt)
+                timeout = min(MAX_TIMEOUT_SEC, max(MIN_TIMEOUT_SEC, 4 * max_rtt))
+                log.info(f"{self.port} {baudrate} 8{parity}1 slave {slave} answered in {rtt * 1000:.0f} ms, timeout now {timeout * 1000:.0f} ms")
+            for info in found:
+                await self.measure(tester, info, max(timeout, 3 * (info.rtt or timeout)))
+        finally:
+            tester.close()
+        return found
+
+    async def scan(self, baudrates=BAUDRATES, parities=PARITIES, scan_all: bool = False) -> list[SlaveInfo]:
+        """Sweep line settings, stops at the first one with responders unless scan_all"""
+        results = []
+        for baudrate in baudrates:
+            for parity in parities:
+                started = time.monotonic()
+                found = await self.scan_setting(baudrate, parity)
+                log.info(f"{self.port} {baudrate} 8{parity}1 scanned in {time.monotonic() - started:.1f} sec, {len(found)} slaves")
+                results.extend(found)
+                if found and not scan_all:
+                    return results
+        return results
+
+
+def config_snippet(results: list[SlaveInfo]) -> str:
+    """Config lines for config.py, one block per bus and line setting"""
+    lines = []
+    settings = {}
+    for info in results:
+        settings.setdefault((info.port, info.baudrate, info.parity), []).append(info)
+    for (port, baudrate, parity), infos in settings.items():
+        lines.append(f"# {port} {baudrate} 8{parity}1, max block {min(info.max_block for info in infos)} registers, "
+                     f"RTT max {max((info.rtt or 0) for info in infos) * 1000:.0f} ms")
+        lines.append(f"self.serial_device = \"{port}\"")
+        lines.append(f"self.serial_baudrate = {baudrate}")
+        lines.append(f"self.modbus_slaves = {[info.slave for info in infos]}")
+    return "\n".join(lines)
+
+
+async def main():
+    ports = sys.argv[1:] or ["/dev/ttyUSB0"]
+    started = time.monotonic()
+    # Buses are independent, only slaves on one bus have to be scanned one by one
+    scans = await asyncio.gather(*(BusScanner(port).scan() for port in ports), return_exceptions=True)
+    results = []
+    for port, scan in zip(ports, scans):
+        if isinstance(scan, Exception):
+            print(f"{port}: scan failed: {scan}")
+            continue
+        results.extend(scan)
+    print("==========================")
+    for info in results:
+        print(info)
+    print("==========================")
+    print(config_snippet(results))
+    print(f"Scan complete in {time.monotonic() - started:.1f} sec")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)
+    asyncio.run(main())
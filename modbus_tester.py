@@ -12,15 +12,19 @@ SERIAL_PARITY = "SERIAL_PARITY"
 SLAVE = 100
 
 class Tester:
-    def __init__(self):
+    def __init__(self, cfg: dict = None):
         self.cfg = {
             SERIAL_PORT: "/dev/ttyUSB0",
             SERIAL_BAUDRATE: 9600,
             SERIAL_STOPBITS: 1,
             SERIAL_PARITY: "E",
         }
+        if cfg:
+            self.cfg.update(cfg)
+        self.client = None
 
-    async def run(self):
+    async def connect(self, **kwargs) -> bool:
+        """Open serial client, kwargs go to pymodbus client (timeout, retries...)"""
         self.client = AsyncModbusSerialClient(
             port=self.cfg[SERIAL_PORT],  # serial port
             # Common optional paramers:
@@ -36,8 +40,17 @@ class Tester:
             parity=self.cfg[SERIAL_PARITY],
             stopbits=self.cfg[SERIAL_STOPBITS],
             #    handle_local_echo=False,
+            **kwargs,
         )
-        await self.client.connect()
+        return await self.client.connect()
+
+    def close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+
+    async def run(self):
+        await self.connect()
         result = await self.client.read_holding_registers(0, 32, slave=SLAVE)
         decoder = BinaryPayloadDecoder.fromRegisters(result.registers, byteorder=Endian.BIG, wordorder=Endian.BIG)
         u1 = decoder.decode_32bit_float()
@@ -35,7 +35,8 @@ class Msg:
 
 
 class MsgDb:
-    def __init__(self):
+    def __init__(self, path: str = None):
+        self.path = path or "./db/%s" % DB_NAME
         self.db = None
 
     @classmethod
@@ -53,7 +54,7 @@ class MsgDb:
             os.spawnl(os.P_NOWAIT, '/bin/gzip', '-f', backup_file)
 
     async def connect(self):
-        self.db = await aiosqlite.connect("./db/%s" % DB_NAME)
+        self.db = await aiosqlite.connect(self.path)
         log.info("MsDb connected")
         #await self.drop_table()
         await self.check_create_table()
@@ -108,6 +109,13 @@ class MsgDb:
         log.debug("Pending msg: %s" % msg)
         return msg
 
+    async def pending_count(self) -> int:
+        sql = "SELECT COUNT(*) FROM %s WHERE state = '%s';" % (TABLE_NAME, STATE_PENDING)
+        cursor = await self.db.execute(sql)
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row[0]
+
     async def insert_message(self, topic: str, msg:str) -> int:
         state = STATE_PENDING
         log.debug("Inserting: " + msg)
@@ -0,0 +1,118 @@
+import logging
+import time
+from typing import Dict, List
+
+from invertor import Invertor
+
+log = logging.getLogger(__name__)
+
+DEADBAND_KW = 2
+HEADROOM_MARGIN = 0.05  # part of nominal power an unlimited invertor gets above its live power
+LIVE_POWER_MAX_AGE_SEC = 900
+
+
+class PlantController:
+    """Distributes plant power cap requested by RTU across invertors
+
+    Invertors producing clearly below their setpoint (shading, standby) get their live
+    power plus a margin, offline ones the margin only, the rest of the cap goes to invertors limited by
+    their setpoint. Sum of setpoints never exceeds the plant cap.
+    """
+    def __init__(self, deadband_kw: float = DEADBAND_KW, margin: float = HEADROOM_MARGIN):
+        self.deadband_kw = deadband_kw
+        self.margin = margin
+
+    def demand(self, invertor: Invertor, now: float) -> float:
+        """Power the invertor is expected to use, nominal power when it may be limited by its setpoint
+
+        Offline invertors (no fresh reading, failed read or not producing) get the margin only,
+        once back their live power reaches the setpoint and they get a full share again.
+        """
+        margin = self.margin * invertor.nominal_power
+        if (invertor.active_power_at is None or now - invertor.active_power_at > LIVE_POWER_MAX_AGE_SEC
+                or not invertor.producing()):
+            return margin
+        # Compare with the setpoint in force when the power was measured, not the one written since
+        setpoint = invertor.active_power_setpoint
+        if setpoint is None or invertor.active_power >= setpoint - margin / 2:
+            return invertor.nominal_power
+        return min(invertor.nominal_power, max(0.0, invertor.active_power) + margin)
+
+    def allocate(self, regulation: int, invertors: List[Invertor]) -> Dict[int, int]:
+        """Returns setpoint in kW per slave address for plant regulation in percent, O(n)"""
+        total_nominal = sum(invertor.nominal_power for invertor in invertors)
+        if regulation >= 100 or regulation <= 0 or not total_nominal:
+            return {invertor.slave_address: int(regulation * invertor.nominal_power / 100) for invertor in invertors}
+
+        cap = regulation * total_nominal / 100
+        now = time.monotonic()
+        demands = [self.demand(invertor, now) for invertor in invertors]
+        unlimited_demand = 0.0
+        limited_nominal = 0.0
+        for invertor, demand in zip(invertors, demands):
+            if demand < invertor.nominal_power:
+                unlimited_demand += demand
+            else:
+                limited_nominal += invertor.nominal_power
+
+        # Invertors below their setpoint get what they produce, the rest of the cap goes
+        # to the limited ones by nominal power, or everything is scaled down if even
+        # the unlimited ones alone exceed the cap
+        setpoints = {}
+        scale = min(1.0, cap / unlimited_demand) if unlimited_demand else 1.0
+        remaining = max(0.0, cap - unlimited_demand)
+        for invertor, demand in zip(invertors, demands):
+            if demand < invertor.nominal_power:
+                share = demand * scale
+                if not limited_nominal:
+                    share += remaining * demand / unlimited_demand
+            else:
+                share = remaining * invertor.nominal_power / limited_nominal
+            setpoints[invertor.slave_address] = int(min(invertor.nominal_power, share))
+        return setpoints
+
+    def plan(self, regulation: int, invertors: List[Invertor], regulation_changed: bool) -> Dict[int, int]:
+        """Allocate setpoints, keeping current ones that moved less than deadband"""
+        setpoints = self.allocate(regulation, invertors)
+        if regulation_changed:
+            return setpoints
+        for invertor in invertors:
+            current = invertor.power_adjust
+            if current is not None and abs(setpoints[invertor.slave_address] - current) <= self.deadband_kw:
+                setpoints[invertor.slave_address] = current
+        # Keeping old setpoints must not push the plant over the cap
+        cap = regulation * sum(invertor.nominal_power for invertor in invertors) / 100
+        if sum(setpoints.values()) > cap:
+            return self.allocate(regulation, invertors)
+        return setpoints
+
+
+def check():
+    """Allocation of 60 % of 4 x 110 kW with one shaded and one offline invertor"""
+    from invertor import OPER_STATUS_NORMAL
+    invertors = [Invertor(no, no, 110) for no in range(1, 5)]
+    for invertor in invertors:
+        invertor.set_power_adjust(66)
+        invertor.set_active_power(66.0)
+        invertor.oper_status = OPER_STATUS_NORMAL
+    invertors[0].set_active_power(20.0)
+    controller = PlantController()
+    for case in ("stale", "failed", "standby", "zero"):
+        offline = invertors[3]
+        offline.set_active_power(0.0)
+        offline.oper_status = OPER_STATUS_NORMAL
+        if case == "stale":
+            offline.active_power_at -= LIVE_POWER_MAX_AGE_SEC + 1
+        elif case == "failed":
+            offline.invalidate_active_power()
+        elif case == "standby":
+            offline.oper_status = 0
+        setpoints = controller.allocate(60, invertors)
+        print(f"{case:8} {setpoints}")
+        assert sum(setpoints.values()) <= 264
+        assert setpoints[4] <= 6, "offline invertor must not take a full share"
+        assert setpoints[2] == setpoints[3] >= 100, "cap goes to the producing invertors"
+
+
+if __name__ == '__main__':
+    check()
@@ -100,6 +100,8 @@ class RegName(Enum):
     RTC_DAY_HOUR = auto()
     RTC_MINUTE_SECOND = auto()
 
+    POWER_ADJUST = auto()
+
 
 
 class Space:
@@ -319,10 +321,12 @@ class GoodweHTRegs:
             RegName.RTC_YEAR_MONTH: Reg("RTC Year/Month", "rtc_year_month", RegType.U16, 41313),
             RegName.RTC_DAY_HOUR: Reg("RTC Day/Hour", "rtc_day_hour", RegType.U16, 41314),
             RegName.RTC_MINUTE_SECOND: Reg("RTC Minute/Second", "rtc_minute_second", RegType.U16, 41315),
+
+            RegName.POWER_ADJUST: Reg("Power Adjust", "power_adjust", RegType.U16, 41480),
         }
         self.total_regs_count = self.calculate_regs_count()
         self.last_plant_data_addr = self.get(RegName.ACTIVE_POWER_CALCULATION).address
-        self.skip_names = ["power_generation_day", "power_generation_month", "power_generation_year", "active_power_calculation", "rtc_year_month", "rtc_day_hour", "rtc_minute_second"]
+        self.skip_names = ["power_generation_day", "power_generation_month", "power_generation_year", "active_power_calculation", "rtc_year_month", "rtc_day_hour", "rtc_minute_second", "power_adjust"]
 
     def set_value(self, name: RegName, value):
         reg: Reg = self.regs[name]
@@ -1,38 +1,124 @@
 import asyncio
+import time
 
 from advantech_adam import AdamDevice
 from config import Config
+from metrics import Histogram
 import logging
 
 log = logging.getLogger(__name__)
 
 
 DEFAULT_REGULATION = 100
+ADAM_TIMEOUT_SEC = 1
+ADAM_RETRIES = 1
+RECONNECT_MIN_SEC = 1
+RECONNECT_MAX_SEC = 60
+HEARTBEAT_SEC = 10
+STATS_LOG_SEC = 600
 
 class RtuMonitor:
     def __init__(self, adam_ip: str):
-        self.adam = AdamDevice(adam_ip)
+        self.adam = AdamDevice(adam_ip, timeout=ADAM_TIMEOUT_SEC, retries=ADAM_RETRIES)
         self.connected = False
-
+        self.reconnect_delay = RECONNECT_MIN_SEC
+        self.reconnect_at = 0.0
+        self.last_read_at = 0.0
+        self.last_inputs = None
+        self.last_regulation = DEFAULT_REGULATION
+        self.input_changes = 0
+        # Called with (inputs, regulation) only when the DI bit pattern changes
+        self.change_listeners = []
+        self.read_latency = Histogram("adam_read_seconds", "ADAM digital inputs read latency")
+        self.stats_logged_at = time.monotonic()
+        self.heartbeat_task = None
+
+    def start(self):
+        """Start heartbeat keeping the ADAM session checked when it is not polled"""
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.create_task(self.heartbeat_loop())
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_SEC)
+            if not self.connected or time.monotonic() - self.last_read_at < HEARTBEAT_SEC:
+                continue
+            try:
+                await self.read_inputs()
+            except Exception as e:
+                log.error(f"Error REG_ERROR ADAM heartbeat failed: {e}")
+                await self.connection_failed()
+
+    async def ensure_connected(self) -> bool:
+        if self.connected and self.adam.connected:
+            return True
+        if time.monotonic() < self.reconnect_at:
+            return False
+        if await self.adam.connect():
+            self.connected = True
+            self.reconnect_delay = RECONNECT_MIN_SEC
+            return True
+        await self.connection_failed()
+        return False
+
+    async def connection_failed(self):
+        """Drop the session and schedule reconnect with bounded exponential backoff"""
+        self.connected = False
+        await self.adam.disconnect()
+        self.reconnect_at = time.monotonic() + self.reconnect_delay
+        log.info(f"ADAM reconnect in {self.reconnect_delay} sec")
+        self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_MAX_SEC)
+
+    async def read_inputs(self) -> list[bool]:
+        started = time.monotonic()
+        inputs = await self.adam.read_digital_inputs(count=4)
+        if inputs is None:
+            raise Exception("No digital inputs received")
+        self.last_read_at = time.monotonic()
+        self.read_latency.observe(self.last_read_at - started)
+        if inputs != self.last_inputs:
+            self.inputs_changed(inputs)
+        return inputs
+
+    def inputs_changed(self, inputs: list[bool]):
+        regulation = self.inputs_to_regulation(inputs)
+        log.info(f"regulation = {regulation} inputs: {inputs}, previous inputs: {self.last_inputs}")
+        self.last_inputs = inputs
+        self.last_regulation = regulation
+        self.input_changes += 1
+        for listener in self.change_listeners:
+            try:
+                listener(inputs, regulation)
+            except Exception as e:
+                log.error(f"Error in RTU change listener: {e}")
+
+    def log_stats(self):
+        if time.monotonic() - self.stats_logged_at < STATS_LOG_SEC:
+            return
+        self.stats_logged_at = time.monotonic()
+        log.info(f"ADAM input changes {self.input_changes}, {self.read_latency.summary()}")
 
     # Method returns requested regulation in percent 0- full reguilation, 100 - no regulation, defaulting to DEFAULT_REGULATION
     async def read_requested_regulation(self) -> int:
         try:
-            if not self.connected:
-                await self.adam.connect()
-                self.connected = True
+            if not await self.ensure_connected():
+                log.debug(f"ADAM not connected, default regulation to {DEFAULT_REGULATION}")
+                return DEFAULT_REGULATION
         except Exception as e:
             log.error(f"Error REG_ERROR while connecting to ADAM: {e}, default regulation to {DEFAULT_REGULATION}")
+            await self.connection_failed()
             return DEFAULT_REGULATION
 
         try:
-            inputs = await self.adam.read_digital_inputs(count=4)
-            regulation = self.inputs_to_regulation(inputs)
-            log.info(f"regulation = {regulation} inputs: {inputs}")
+            inputs = await self.read_inputs()
+            # Decoded once per change of inputs
+            regulation = self.last_regulation
+            log.debug(f"regulation = {regulation} inputs: {inputs}")
+            self.log_stats()
             return regulation
         except Exception as e:
             log.error(f"Error REG_ERROR while getting inputs from ADAM: {e}, default regulation to {DEFAULT_REGULATION}")
-            self.connected = False
+            await self.connection_failed()
             return DEFAULT_REGULATION
 
     # When input is swtiched on then its False, if is not switched, then its True
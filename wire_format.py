@@ -0,0 +1,135 @@
+import datetime
+import json
+import logging
+import struct
+import time
+import zlib
+
+from message_encoder import FRAME_DELTA, FRAME_KEY, INVERTOR_TYP, orjson
+from registers_goodwe_ht import GoodweHTRegs, RegType
+
+log = logging.getLogger(__name__)
+
+JSON_CONTENT_TYPE = "application/json"
+PACKED_CONTENT_TYPE = "application/vnd.joyce.goodweht-record"
+PACKED_MAGIC = b"GW"
+PACKED_VERSION = 1
+FRAMES = (None, FRAME_KEY, FRAME_DELTA)
+POWER_ADJUST_NONE = -1
+POWER_ADJUST_ABSENT = -2 # delta without power adjust change
+# magic, version, layout id, frame, invertor no, slave, power adjust, timestamp, rtc (year - 2000 ... second), seq, key seq, plant length
+HEADER = struct.Struct("<2sBIBHBhI6BIIB")
+INTEGER_CODES = {RegType.U16: "H", RegType.I16: "h", RegType.U32: "I", RegType.I32: "i"}
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+loads = orjson.loads if orjson else json.loads
+
+
+class PackedRecordCodec:
+    """Fixed layout binary record of the cloud message, little endian
+
+    Field order and types come from the register map, values with a multiplier go
+    as integer hundredths as they are rounded in the JSON, registers without one
+    as their raw integer, strings as fixed length bytes. The layout id is a CRC of
+    the field list and is part of the Content-Type, receiver with another register
+    map answers 415. Delta messages carry a bitmap of the fields present.
+    """
+    def __init__(self, regs: GoodweHTRegs):
+        skip_names = set(regs.skip_names)
+        self.fields = []  # (key, struct code, scaled, is string)
+        for reg in regs.regs.values():
+            if reg.json_name in skip_names:
+                continue
+            if reg.typ == RegType.STR:
+                self.fields.append((reg.json_name, f"{2 * reg.multiplier}s", False, True))
+            elif reg.typ == RegType.F32 or isinstance(reg.multiplier, float):
+                self.fields.append((reg.json_name, "i" if reg.get_size() == 1 else "q", True, False))
+            else:
+                self.fields.append((reg.json_name, INTEGER_CODES[reg.typ], False, False))
+        self.layout_id = zlib.crc32(";".join(f"{key}:{code}:{scaled:d}" for key, code, scaled, _ in self.fields).encode())
+        self.content_type = f"{PACKED_CONTENT_TYPE}; layout={self.layout_id:08x}"
+        self.values = struct.Struct("<" + "".join(code for _, code, _, _ in self.fields))
+        self.bitmap_size = (len(self.fields) + 7) // 8
+        self.keys = frozenset(key for key, _, _, _ in self.fields)
+
+    def accepts(self, content_type: str) -> bool:
+        return content_type.replace(" ", "") == self.content_type.replace(" ", "")
+
+    @staticmethod
+    def encode_value(value, scaled: bool, is_str: bool):
+        if is_str:
+            return value.encode()
+        if scaled:
+            return round(value * 100)
+        return value
+
+    @staticmethod
+    def decode_value(value, scaled: bool, is_str: bool):
+        if is_str:
+            return value.rstrip(b"\0").decode()
+        if scaled:
+            return value / 100
+        return value
+
+    def pack(self, message: dict) -> bytes:
+        frame = message.get("frame")
+        rtc_date, rtc_time = message["rtc"].split(" ")
+        year, month, day = (int(part) for part in rtc_date.split("-"))
+        hour, minute, second = (int(part) for part in rtc_time.split(":"))
+        power_adjust = message.get("power_adjust", POWER_ADJUST_ABSENT)
+        plant = message["plant"].encode()
+        header = HEADER.pack(
+            PACKED_MAGIC, PACKED_VERSION, self.layout_id, FRAMES.index(frame), message["invertor_no"], message["slave_address"],
+            POWER_ADJUST_NONE if power_adjust is None else power_adjust,
+            int(datetime.datetime.fromisoformat(message["timestamp"]).timestamp()), year - 2000, month, day, hour, minute, second,
+            message.get("seq", 0), message.get("key_seq", 0), len(plant))
+        if frame != FRAME_DELTA:
+            values = self.values.pack(*[self.encode_value(message[key], scaled, is_str) for key, _, scaled, is_str in self.fields])
+            return header + plant + values
+        bitmap = 0
+        codes = ["<"]
+        values = []
+        for i, (key, code, scaled, is_str) in enumerate(self.fields):
+            if key in message:
+                bitmap |= 1 << i
+                codes.append(code)
+                values.append(self.encode_value(message[key], scaled, is_str))
+        return header + plant + bitmap.to_bytes(self.bitmap_size, "little") + struct.pack("".join(codes), *values)
+
+    def unpack(self, body: bytes) -> dict:
+        (magic, version, layout_id, frame, invertor_no, slave_address, power_adjust, timestamp,
+         year, month, day, hour, minute, second, seq, key_seq, plant_length) = HEADER.unpack_from(body)
+        if magic != PACKED_MAGIC or version != PACKED_VERSION or layout_id != self.layout_id:
+            raise ValueError(f"Unsupported record {magic} version {version} layout {layout_id:08x}")
+        offset = HEADER.size
+        message = {
+            "plant": body[offset:offset + plant_length].decode(),
+            "invertor_no": invertor_no,
+            "invertor_typ": INVERTOR_TYP,
+            "slave_address": slave_address,
+        }
+        offset += plant_length
+        if power_adjust != POWER_ADJUST_ABSENT:
+            message["power_adjust"] = None if power_adjust == POWER_ADJUST_NONE else power_adjust
+        message["timestamp"] = time.strftime(TIMESTAMP_FORMAT, time.gmtime(timestamp))
+        message["rtc"] = f"{2000 + year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}:{second:02d}"
+        frame = FRAMES[frame]
+        if frame is None:
+            fields = self.fields
+            values = self.values.unpack_from(body, offset)
+        else:
+            message["seq"] = seq
+            message["frame"] = frame
+            fields = self.fields
+            if frame == FRAME_DELTA:
+                message["key_seq"] = key_seq
+                bitmap = int.from_bytes(body[offset:offset + self.bitmap_size], "little")
+                offset += self.bitmap_size
+                fields = [field for i, field in enumerate(self.fields) if bitmap >> i & 1]
+                values = struct.unpack_from("<" + "".join(code for _, code, _, _ in fields), body, offset)
+            else:
+                values = self.values.unpack_from(body, offset)
+        for (key, _, scaled, is_str), value in zip(fields, values):
+            message[key] = self.decode_value(value, scaled, is_str)
+        return message
+